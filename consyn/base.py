@@ -15,21 +15,51 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """Base classes for processing media files"""
 from __future__ import unicode_literals
+import Queue
 import collections
+import functools
+import itertools
+import multiprocessing
+import multiprocessing.pool
+import threading
+import time
 
 
 __all__ = [
+    "allocations",
     "AudioFrame",
     "Stage",
+    "Pipeline",
+    "StageProfile",
+    "ThreadedPipeline",
     "FileLoaderStage",
     "UnitLoaderStage",
+    "PrefetchUnitLoader",
+    "ParallelStage",
     "SegmentationStage",
     "SelectionStage",
     "SynthesisStage",
-    "AnalysisStage"
+    "AnalysisStage",
+    "ChannelAnalyser"
 ]
 
 
+class _Allocations(collections.Counter):
+    """Counts of allocations, added to from any thread"""
+
+    def __init__(self):
+        super(_Allocations, self).__init__()
+        self.lock = threading.Lock()
+
+    def add(self, kind, count=1):
+        with self.lock:
+            self[kind] += count
+
+
+# Number of frames and sample buffers allocated, for profiling
+allocations = _Allocations()
+
+
 class AudioFrame(object):
     """Container for a section of audio being processed.
 
@@ -38,6 +68,7 @@ class AudioFrame(object):
       samplerate (int): Sampling rate of the media file
       position (int): Position of samples in the original media file
       channel (int): The channel the samples belong to
+      index (int): Index of the frame in the stream it was read from
       path (str): Path of the media file
       duration (int): Duration of the section of samples
 
@@ -52,17 +83,33 @@ class AudioFrame(object):
         "duration"
     ]
 
-    def __init__(self, *args, **kwargs):
-        for key in kwargs:
-            setattr(self, key, kwargs[key])
+    def __init__(self, samples=None, samplerate=None, position=None,
+                 channel=None, index=None, path=None, duration=None):
+        self.samples = samples
+        self.samplerate = samplerate
+        self.position = position
+        self.channel = channel
+        self.index = index
+        self.path = path
+        self.duration = duration
+        allocations.add("frames")
 
     def __len__(self):
         return self.duration
 
+    def copy(self):
+        """A copy of the frame, with a copy of its samples."""
+        samples = self.samples
+        if samples is not None:
+            samples = samples.copy()
+            allocations.add("buffers")
+        return AudioFrame(samples, self.samplerate, self.position,
+                          self.channel, self.index, self.path, self.duration)
+
     def __repr__(self):
         keys = ["position", "duration", "channel", "samplerate"]
         values = ["{}={}".format(key, getattr(self, key)) for key in keys
-                  if hasattr(self, key)]
+                  if getattr(self, key) is not None]
         return "<AudioFrame({})>".format(", ".join(values))
 
 
@@ -70,16 +117,269 @@ class Stage(object):
     pass
 
 
+class StageProfile(object):
+    """Number of pools passed on by a stage of a pipeline, and time spent.
+
+    Attributes:
+      name (str): Name of the stage
+      count (int): Number of pools the stage passed on
+      total (float): Seconds spent in the stage, including its input
+      upstream (float): Seconds the stage spent waiting on its input
+
+    """
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.upstream = 0.0
+
+    @property
+    def time(self):
+        """Seconds spent in the stage itself."""
+        return max(0.0, self.total - self.upstream)
+
+    @property
+    def throughput(self):
+        """Pools passed on per second of time spent in the stage itself."""
+        return self.count / self.time if self.time > 0 else 0.0
+
+    def __call__(self, stage, pipe, first=False):
+        start = time.time()
+        result = stage(pipe if first else self.input(pipe))
+        self.total += time.time() - start
+
+        if isinstance(result, collections.Iterator):
+            return self.output(result)
+        if isinstance(result, collections.Sized):
+            self.count += len(result)
+        return result
+
+    def input(self, pipe):
+        pipe = iter(pipe)
+        while True:
+            start = time.time()
+            try:
+                pool = next(pipe)
+            except StopIteration:
+                return
+            finally:
+                self.upstream += time.time() - start
+            yield pool
+
+    def output(self, pipe):
+        while True:
+            start = time.time()
+            try:
+                pool = next(pipe)
+            except StopIteration:
+                return
+            finally:
+                self.total += time.time() - start
+            self.count += 1
+            yield pool
+
+
 class Pipeline(object):
+    """Chain stages, each consuming the pools passed on by the one before.
+
+    Kwargs:
+      profile (bool): Count and time the pools passed on by each stage
+
+    Attributes:
+      profiles (list): A StageProfile for each stage, from the latest run
 
-    def __init__(self, stages):
+    """
+    def __init__(self, stages, profile=False):
         self.stages = stages
+        self.profile = profile
+        self.profiles = []
 
     def run(self, *args):
-        pool = self.stages[0](args)
-        for stage in self.stages[1:]:
-            pool = stage(pool)
+        self.start()
+        return self.chain(0, len(self.stages), None, args)
+
+    def start(self):
+        self.profiles = []
+        if self.profile:
+            self.profiles = [StageProfile(self.name(stage))
+                             for stage in self.stages]
+
+    def chain(self, start, end, pipe, args):
+        for index in range(start, end):
+            stage = self.stages[index]
+            first = index == 0
+            pipe = args if first else pipe
+            if self.profile:
+                pipe = self.profiles[index](stage, pipe, first=first)
+            else:
+                pipe = stage(pipe)
+        return pipe
+
+    def name(self, stage):
+        name = getattr(stage, "__name__", None)
+        return name if name else type(stage).__name__
+
+    def queue_peaks(self):
+        """Largest and maximum size of each queue between stages."""
+        return []
+
+    def summary(self):
+        """A table of the profiles of each stage, from the latest run."""
+        if not self.profiles:
+            return "No profiles, the pipeline has not run with profile set"
+
+        lines = ["{:<24} {:>8} {:>10} {:>10} {:>10}".format(
+            "stage", "pools", "self (s)", "wait (s)", "pools/s")]
+        for profile in self.profiles:
+            lines.append("{:<24} {:>8} {:>10.3f} {:>10.3f} {:>10.1f}".format(
+                profile.name[:24], profile.count, profile.time,
+                profile.upstream, profile.throughput))
+
+        for index, (peak, maxsize) in enumerate(self.queue_peaks()):
+            lines.append("queue {} peak size {}/{}".format(
+                index, peak, maxsize))
+        return "\n".join(lines)
+
+
+def _copy_pool(pool):
+    """Copy a pool and its frames, to hand it over to another thread.
+
+    Frames may be reused by the stage that made them, and their samples
+    may be a view into a decoder's buffer that is overwritten by the next
+    read, so they are only valid until that stage is resumed.
+
+    """
+    if not isinstance(pool, dict):
         return pool
+    pool = dict(pool)
+    for key, value in pool.items():
+        if isinstance(value, AudioFrame):
+            pool[key] = value.copy()
+    return pool
+
+
+class _Failure(object):
+
+    __slots__ = ["error"]
+
+    def __init__(self, error):
+        self.error = error
+
+
+# Marks the end of the pools passed between threads
+_DONE = object()
+
+
+class ThreadedPipeline(Pipeline):
+    """Run groups of stages in their own threads, joined by bounded queues.
+
+    A group waits when the queue it feeds is full, so a slow stage holds
+    back the stages before it instead of pools piling up in memory. The
+    last group runs in the calling thread. Pools keep their order, and an
+    exception raised in any group is raised again by the last group.
+
+    Pools and their frames are copied as they are queued, as stages are
+    free to reuse the pools and frames they pass on (see FileLoaderStage).
+    Stages sharing a database session must be kept in the same group.
+
+    Args:
+      stages (list): The stages of the pipeline
+
+    Kwargs:
+      boundaries (list): Indexes of the stages starting a new group, by
+                         default every stage runs in its own thread
+      maxsize (int): Maximum number of pools waiting in each queue
+
+    Attributes:
+      queues (list): The queues between groups, from the latest run
+      peaks (list): Largest size each queue reached in the latest run
+
+    """
+    def __init__(self, stages, boundaries=None, maxsize=16, profile=False):
+        super(ThreadedPipeline, self).__init__(stages, profile=profile)
+        if boundaries is None:
+            boundaries = range(1, len(stages))
+        self.boundaries = sorted(set(boundaries))
+        self.maxsize = max(1, maxsize)
+        self.queues = []
+        self.closed = []
+        self.peaks = []
+
+    def groups(self):
+        return [self.stages[start:end] for start, end in self.ranges()]
+
+    def ranges(self):
+        bounds = [index for index in self.boundaries
+                  if 0 < index < len(self.stages)]
+        bounds = [0] + bounds + [len(self.stages)]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def sizes(self):
+        """Number of pools waiting in each queue."""
+        return [queue.qsize() for queue in self.queues]
+
+    def queue_peaks(self):
+        return [(peak, self.maxsize) for peak in self.peaks]
+
+    def run(self, *args):
+        self.start()
+        ranges = self.ranges()
+        self.queues = [Queue.Queue(maxsize=self.maxsize)
+                       for _ in ranges[1:]]
+        self.closed = [threading.Event() for _ in ranges[1:]]
+        self.peaks = [0] * len(self.queues)
+
+        pipe = None
+        for index, (start, end) in enumerate(ranges[:-1]):
+            thread = threading.Thread(target=self.work,
+                                      args=(index, start, end, pipe, args))
+            thread.daemon = True
+            thread.start()
+            pipe = self.receive(index)
+
+        try:
+            start, end = ranges[-1]
+            return self.chain(start, end, pipe, args)
+        except BaseException:
+            if self.closed:
+                self.closed[-1].set()
+            raise
+
+    def work(self, index, start, end, pipe, args):
+        try:
+            for pool in self.chain(start, end, pipe, args):
+                if not self.put(index, _copy_pool(pool)):
+                    return
+            item = _DONE
+        except Exception as error:
+            item = _Failure(error)
+        self.put(index, item)
+
+    def put(self, index, item):
+        queue = self.queues[index]
+        while not self.closed[index].is_set():
+            try:
+                queue.put(item, timeout=0.1)
+            except Queue.Full:
+                continue
+            self.peaks[index] = max(self.peaks[index], queue.qsize())
+            return True
+        return False
+
+    def receive(self, index):
+        # Stopping early closes the queue, its producer then stops too,
+        # which in turn closes the queue before it
+        try:
+            while True:
+                item = self.queues[index].get()
+                if item is _DONE:
+                    break
+                if isinstance(item, _Failure):
+                    raise item.error
+                yield item
+        except GeneratorExit:
+            self.closed[index].set()
+            raise
 
 
 class FileLoaderStage(Stage):
@@ -87,12 +387,24 @@ class FileLoaderStage(Stage):
 
     Kwargs:
       hopsize (int): The size of frames to read
-      key (function): Function for getting a filepath from the current context
+      reuse_frames (bool): Update one frame per channel in place, instead of
+                           allocating a frame for every hop. Frames are then
+                           only valid until the next frame is read.
+                           ThreadedPipeline and ParallelStage copy frames
+                           as they queue them, undoing the saving, so reuse
+                           frames only when the stages reading them run in
+                           the same thread as the loader.
+      channels (list): Only generate frames for these channels, defaults to
+                       every channel in the file
 
     """
-    def __init__(self, filepath, hopsize=1024):
+    def __init__(self, filepath, hopsize=1024, reuse_frames=False,
+                 channels=None):
         self.filepath = filepath
         self.hopsize = hopsize
+        self.reuse_frames = reuse_frames
+        self.channels = channels
+        self.frames = {}
 
     def __call__(self, *args):
         for frame in self.read(self.filepath):
@@ -104,6 +416,29 @@ class FileLoaderStage(Stage):
     def read(self, path):
         raise NotImplementedError("FileLoaderStages must implement this")
 
+    def selected(self, channel):
+        return self.channels is None or channel in self.channels
+
+    def get_frame(self, samples, samplerate, position, channel, index, path,
+                  duration):
+        if not self.reuse_frames:
+            return AudioFrame(samples, samplerate, position, channel, index,
+                              path, duration)
+
+        frame = self.frames.get(channel)
+        if frame is None:
+            frame = AudioFrame(samples, samplerate, position, channel, index,
+                               path, duration)
+            self.frames[channel] = frame
+        else:
+            frame.samples = samples
+            frame.samplerate = samplerate
+            frame.position = position
+            frame.index = index
+            frame.path = path
+            frame.duration = duration
+        return frame
+
 
 class UnitLoaderStage(Stage):
     """Base class for generating a stream of AudioFrames from Units"""
@@ -127,6 +462,185 @@ class UnitLoaderStage(Stage):
         raise NotImplementedError("UnitLoaderStages must implement this")
 
 
+class _UnitRequest(object):
+
+    __slots__ = ["path", "unit", "frames", "error", "done"]
+
+    def __init__(self, path, unit):
+        self.path = path
+        self.unit = unit
+        self.frames = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class PrefetchUnitLoader(Stage):
+    """Read upcoming units on a pool of threads, ahead of the pipeline.
+
+    Wraps a UnitLoaderStage so that reading the next units from disk overlaps
+    with the processing of the current unit by the stages further down.
+
+    Args:
+      loader (UnitLoaderStage): The loader used to read each unit
+
+    Kwargs:
+      depth (int): Maximum number of units to read ahead
+      workers (int): Number of threads reading units
+
+    """
+    def __init__(self, loader, depth=8, workers=2):
+        super(PrefetchUnitLoader, self).__init__()
+        self.loader = loader
+        self.depth = max(1, depth)
+        self.workers = max(1, workers)
+
+    def __call__(self, pipe):
+        requests = Queue.Queue(maxsize=self.depth)
+        pending = collections.deque()
+        threads = []
+
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self.work, args=(requests,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        try:
+            for context in pipe:
+                request = _UnitRequest(self.loader.key(context),
+                                       context["unit"])
+                requests.put(request)
+                pending.append((context, request))
+
+                if len(pending) >= self.depth:
+                    for result in self.complete(*pending.popleft()):
+                        yield result
+
+            while pending:
+                for result in self.complete(*pending.popleft()):
+                    yield result
+        finally:
+            for _ in threads:
+                requests.put(None)
+
+        if hasattr(self.loader, "close"):
+            for thread in threads:
+                thread.join()
+            self.loader.close()
+
+    def work(self, requests):
+        while True:
+            request = requests.get()
+            if request is None:
+                break
+            try:
+                request.frames = list(
+                    self.loader.read(request.path, request.unit))
+            except Exception as error:
+                request.error = error
+            request.done.set()
+
+    def complete(self, context, request):
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        for frame in request.frames:
+            context["frame"] = frame
+            yield context
+
+
+def _apply(stage, context):
+    return list(stage([context]))
+
+
+# The stage of a ParallelStage, in each of its worker processes
+_process_stage = None
+
+
+def _initialize_process(stage):
+    global _process_stage
+    _process_stage = stage
+
+
+def _apply_process(context):
+    return _apply(_process_stage, context)
+
+
+class ParallelStage(Stage):
+    """Run a stage over each pool separately, on a pool of workers.
+
+    Suits stages that treat every pool on its own, such as most analysis
+    and synthesis stages. Pools are read from the pipeline in batches by
+    the calling thread, so stages before this one are never called from
+    another thread. While one batch is processed the next is read, so
+    pools and their frames are copied as they are read (see
+    FileLoaderStage).
+
+    With threads the stage is shared by every worker, so it must be safe to
+    call from several threads at once. With processes each worker has a copy
+    of the stage, and pools are pickled on their way to and from it.
+
+    Args:
+      stage (Stage): The stage to run on each pool
+
+    Kwargs:
+      workers (int): Number of workers
+      processes (bool): Use worker processes instead of threads
+      chunksize (int): Number of pools handed to a worker at once
+      ordered (bool): Pass on pools in the order they arrived, otherwise
+                      pools are passed on as soon as they are done
+
+    """
+    def __init__(self, stage, workers=multiprocessing.cpu_count(),
+                 processes=False, chunksize=4, ordered=True):
+        super(ParallelStage, self).__init__()
+        self.stage = stage
+        self.workers = max(1, workers)
+        self.processes = processes
+        self.chunksize = max(1, chunksize)
+        self.ordered = ordered
+
+    def __call__(self, pipe):
+        if self.processes:
+            workers = multiprocessing.Pool(
+                self.workers, _initialize_process, (self.stage,))
+            function = _apply_process
+        else:
+            workers = multiprocessing.pool.ThreadPool(self.workers)
+            function = functools.partial(_apply, self.stage)
+
+        amap = workers.imap if self.ordered else workers.imap_unordered
+        size = self.workers * self.chunksize
+        pipe = iter(pipe)
+        pending = None
+
+        try:
+            while True:
+                batch = [_copy_pool(context)
+                         for context in itertools.islice(pipe, size)]
+                results = amap(function, batch, self.chunksize)
+
+                if pending is not None:
+                    for contexts in pending:
+                        for context in contexts:
+                            yield context
+
+                pending = results
+                if len(batch) < size:
+                    break
+
+            for contexts in pending:
+                for context in contexts:
+                    yield context
+
+            workers.close()
+        except BaseException:
+            workers.terminate()
+            raise
+        finally:
+            workers.join()
+
+
 class SegmentationStage(Stage):
     """Base class for slicing a stream of AudioFrames"""
 
@@ -176,10 +690,10 @@ class SynthesisStage(Stage):
                 context["unit"],
                 context["target"])
             if samples.shape[0] != 0:
-                frame = AudioFrame()
+                frame = context["frame"]
                 frame.samples = samples
+                frame.duration = samples.shape[0]
                 context["unit"] = unit
-                context["frame"] = frame
                 yield context
 
     def process(self, samples, unit, target):
@@ -201,3 +715,31 @@ class AnalysisStage(Stage):
 
     def __len__(self):
         raise NotImplementedError("AnalysisStages must implement this")
+
+
+class ChannelAnalyser(AnalysisStage):
+    """Analyse each channel with an analyser of its own.
+
+    Analysers may keep state from one frame to the next (a phase vocoder for
+    instance), which interleaved channels must not share.
+
+    Args:
+      factory (callable): Returns a new analyser for a channel
+
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.analysers = {}
+
+    def analyse(self, frame):
+        analyser = self.analysers.get(frame.channel)
+        if analyser is None:
+            analyser = self.factory()
+            self.analysers[frame.channel] = analyser
+        return analyser.analyse(frame)
+
+    def __len__(self):
+        if 0 in self.analysers:
+            return len(self.analysers[0])
+        return len(self.factory())
@@ -15,20 +15,33 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import unicode_literals
+import logging
 import os
 
 import click
 from sqlalchemy import create_engine
+from sqlalchemy import event
 from sqlalchemy.orm import sessionmaker
 
 from ..models import Base
+from ..models import migrate
 from ..settings import get_settings
 
 
-__all__ = ["configurator", "main"]
+__all__ = ["configurator", "create_session", "main"]
 
 settings = get_settings(__name__)
 
+# Pragmas set on every SQLite connection, from the sqlite_* settings
+SQLITE_PRAGMAS = [
+    "auto_vacuum",
+    "journal_mode",
+    "synchronous",
+    "cache_size",
+    "mmap_size",
+    "temp_store"
+]
+
 COMMANDS = [
     "add",
     "ls",
@@ -36,6 +49,8 @@ COMMANDS = [
     "cluster",
     "mosaic",
     "show",
+    "snapshot",
+    "project",
     "config"
 ]
 
@@ -52,6 +67,31 @@ class Config(object):
 configurator = click.make_pass_decorator(Config, ensure=True)
 
 
+def configure_sqlite(connection, record):
+    cursor = connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        value = settings.get("sqlite_{}".format(pragma))
+        if value is not None and value != "":
+            cursor.execute("PRAGMA {} = {}".format(pragma, value))
+    cursor.close()
+
+
+def create_session(database):
+    """Create a session on a database, creating its tables if needed."""
+    connect_args = {}
+    if database.startswith("sqlite"):
+        # Sessions are handed over to pipeline threads, see ThreadedPipeline
+        connect_args["check_same_thread"] = False
+
+    engine = create_engine(database, connect_args=connect_args)
+    if database.startswith("sqlite"):
+        event.listen(engine, "connect", configure_sqlite)
+    Base.metadata.create_all(engine)
+    migrate(engine)
+    Session = sessionmaker(bind=engine)
+    return Session()
+
+
 @click.group()
 @click.option("--debug", default=False, is_flag=True,
               help="Enables debug mode.")
@@ -66,14 +106,13 @@ def main(config, debug, verbose, database=settings.get("database")):
     if "://" not in database:
         database = "sqlite:///{}".format(os.path.abspath(database))
 
-    engine = create_engine(database)
-    Base.metadata.create_all(engine)
-    Session = sessionmaker(bind=engine)
+    if debug:
+        logging.basicConfig(level=logging.DEBUG)
 
     config.debug = debug
     config.verbose = verbose
     config.database = database
-    config.session = Session()
+    config.session = create_session(database)
 
 
 for cmd in COMMANDS:
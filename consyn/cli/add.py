@@ -41,10 +41,15 @@ from ..models import MediaFile
               help="Aubio onset threshold.")
 @click.option("--onset-method", default="default",
               help="Aubio onset threshold.")
+@click.option("--storage", default="columns",
+              type=click.Choice(["columns", "packed"]),
+              help="Store features in columns, or packed into one value.")
+@click.option("--jobs", default=1,
+              help="Number of processes to analyse channels in.")
 @click.argument("files", nargs=-1)
 @configurator
 def command(config, files, force, bufsize, hopsize, onset_threshold,
-            onset_method):
+            onset_method, storage, jobs):
 
     if len(files) == 1 and not os.path.isfile(files[0]):
         files = glob(files[0])
@@ -76,7 +81,9 @@ def command(config, files, force, bufsize, hopsize, onset_threshold,
                                           bufsize=bufsize,
                                           hopsize=hopsize,
                                           method=onset_method,
-                                          threshold=onset_threshold)
+                                          threshold=onset_threshold,
+                                          storage=storage,
+                                          jobs=jobs)
 
                 duration += mediafile.duration / mediafile.samplerate
                 config.session.commit()
@@ -23,11 +23,14 @@ from ..commands import cluster_units
 
 
 @click.command("cluster", short_help="Cluster units.")
+@click.option("--projection", default=None,
+              help="Cluster features projected by a projection.")
 @click.argument("clusters")
 @configurator
-def command(config, clusters):
+def command(config, clusters, projection):
     clusters = int(clusters)
-    iterations = cluster_units(config.session, clusters)
+    iterations = cluster_units(config.session, clusters,
+                               projection=projection)
 
     click.secho("Clustering completed sucessfully with {} iterations"
                 .format(iterations), fg="green")
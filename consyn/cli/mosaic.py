@@ -14,18 +14,26 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import unicode_literals
+import logging
+import multiprocessing
 import os
 
 import click
+import numpy
 from sqlalchemy import not_
 
 from . import configurator
+from . import create_session
 from ..base import Pipeline
+from ..base import PrefetchUnitLoader
+from ..base import ThreadedPipeline
 from ..commands import get_mediafile
 from ..concatenators import concatenator
 from ..ext import UnitLoader
 from ..ext import Writer
 from ..models import MediaFile
+from ..models import Unit
+from ..resynthesis import Chain
 from ..resynthesis import Envelope
 from ..resynthesis import SoftClipper
 from ..resynthesis import TimeStretch
@@ -35,6 +43,9 @@ from ..selections import selection
 from ..utils import UnitGenerator
 
 
+logger = logging.getLogger(__name__)
+
+
 class ProgressBar(object):
 
     def __init__(self, size):
@@ -46,25 +57,190 @@ class ProgressBar(object):
                 yield pool
 
 
+def synthesis(session, target, mediafiles, select="nearest", fade=500,
+              gate=0.00001, gate_window=0, gain=1.0, prefetch=0,
+              snapshot=None, seed=None, normalize=False, weights=None,
+              projection=None, start=None, end=None):
+    """Stages that select, load and resynthesise units for a target."""
+    loader = UnitLoader(
+        hopsize=2048,
+        key=lambda state: state["unit"].mediafile.path)
+
+    if prefetch > 0:
+        loader = PrefetchUnitLoader(loader, depth=prefetch)
+
+    return [
+        UnitGenerator(target, session, start=start, end=end),
+        selection(select, session, mediafiles, snapshot=snapshot,
+                  seed=seed, normalize=normalize, weights=weights,
+                  projection=projection),
+        loader,
+        Chain([
+            TrimSilence(cutoff=gate, window=gate_window),
+            Gain(gain=gain),
+            TimeStretch(),
+            Envelope(fade=fade),
+            SoftClipper()
+        ])
+    ]
+
+
+def build_pipeline(stages, boundary, threaded=False, profile=False):
+    """A pipeline for the stages of a mosaic, optionally resynthesising the
+    units in a thread of their own, from the stage at boundary."""
+    if threaded:
+        # Selection and loading share the session, so stay in one thread
+        return ThreadedPipeline(stages, boundaries=[boundary, boundary + 1],
+                                profile=profile)
+    return Pipeline(stages, profile=profile)
+
+
+def partition(session, target, count):
+    """Split the units of a target into time ranges of similar size.
+
+    Units are assigned to the range their position falls in, so all the
+    channels of a position are rendered together.
+
+    """
+    query = session.query(Unit.position).filter(
+        Unit.mediafile_id == target.id).distinct().order_by(Unit.position)
+    positions = [position for (position,) in query]
+
+    count = max(1, min(count, len(positions)))
+    bounds = [0]
+    bounds.extend(positions[i * len(positions) // count]
+                  for i in range(1, count))
+    bounds.append(target.duration)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def render_partition(args):
+    """Render the units of a target in a time range, in a worker process.
+
+    Returns the position the samples start at, and the samples. Units that
+    run past the end of the range are kept whole, to be overlaid on the
+    next range.
+
+    """
+    database, target_id, mediafile_ids, start, end, threaded, options = args
+    session = create_session(database)
+
+    # Draw different random units in each range
+    if options.get("seed") is not None:
+        options = dict(options, seed=options["seed"] + start)
+
+    try:
+        target = session.query(MediaFile).get(target_id)
+        mediafiles = session.query(MediaFile).filter(
+            MediaFile.id.in_(mediafile_ids)).all()
+
+        stages = synthesis(session, target, mediafiles, start=start,
+                           end=end, **options)
+        boundary = len(stages) - 1
+        stages.append(concatenator("stream", target, unit_key="target",
+                                   start=start, end=end))
+        stages.append(list)
+
+        results = build_pipeline(stages, boundary, threaded=threaded).run()
+        return start, numpy.concatenate(
+            [result["buffer"] for result in results], axis=1)
+    finally:
+        session.close()
+
+
+def render(config, target, mediafiles, jobs, memmap, threaded, options):
+    """Render a mosaic in parallel, returning the mosaic buffer.
+
+    Units are overlaid, as with the overlay and stream concatenators.
+
+    """
+    if ":memory:" in config.database or config.database == "sqlite://":
+        raise click.UsageError("--jobs needs a database on disk")
+
+    tasks = [(config.database, target.id,
+              [mediafile.id for mediafile in mediafiles],
+              start, end, threaded, options)
+             for start, end in partition(config.session, target, jobs)]
+
+    mosaic = concatenator("overlay", target, memmap=memmap)
+    workers = multiprocessing.Pool(jobs)
+
+    try:
+        results = workers.imap_unordered(render_partition, tasks)
+        with click.progressbar(results, length=len(tasks)) as prog_results:
+            for position, buff in prog_results:
+                mosaic.overlay(position, buff)
+        workers.close()
+    except BaseException:
+        workers.terminate()
+        raise
+    finally:
+        workers.join()
+
+    return mosaic.get_buffer()
+
+
 @click.command("mosaic", short_help="Create an audio mosaic.")
 @click.option("--force", is_flag=True, default=False,
               help="Overwrite file(s) if already exists.")
 @click.option("--select", default="nearest",
               help="Unit selection algorithm")
-@click.option("--concatenate", default="overlay", help="Concatenation method")
+@click.option("--concatenate", default="overlay",
+              help="Concatenation method (clip, overlay, or stream)")
 @click.option("--fade", default=500, help="Unit fade in/out time")
 @click.option("--gate", default=0.00001, help="Gate level")
+@click.option("--gate-window", default=0,
+              help="Gate on the RMS level of windows of this size")
 @click.option("--gain", default=1.0, help="Unit gain level")
+@click.option("--memmap", is_flag=True, default=False,
+              help="Render the mosaic in a memory mapped temporary file.")
+@click.option("--prefetch", default=0,
+              help="Number of units to read ahead of synthesis")
+@click.option("--snapshot", default=None,
+              help="Load features for the matrix selector from a snapshot.")
+@click.option("--seed", default=None, type=int,
+              help="Seed for the random selector")
+@click.option("--normalize", is_flag=True, default=False,
+              help="Normalise features for the matrix selector.")
+@click.option("--weight", multiple=True,
+              help="Weight of a feature for the matrix selector, as "
+                   "LABEL=WEIGHT")
+@click.option("--projection", default=None,
+              help="Match projected features with the matrix selector.")
+@click.option("--threaded", is_flag=True, default=False,
+              help="Resynthesise units in a thread of their own.")
+@click.option("--jobs", default=1,
+              help="Number of processes to render time ranges of the target")
 @click.argument("output")
 @click.argument("target")
 @click.argument("mediafiles", nargs=-1, required=False)
 @configurator
 def command(config, output, target, mediafiles, force, select, concatenate,
-            fade, gate, gain):
+            fade, gate, gate_window, gain, memmap, prefetch, snapshot,
+            seed, normalize, weight, projection, threaded, jobs):
     if os.path.isfile(output) and not force:
         click.secho("File already exists", fg="red")
         return
 
+    if select != "matrix":
+        for name, value in (("snapshot", snapshot), ("normalize", normalize),
+                            ("weight", weight), ("projection", projection)):
+            if value:
+                raise click.UsageError(
+                    "--{} is only used by --select matrix".format(name))
+
+    if memmap and concatenate == "stream" and jobs <= 1:
+        raise click.UsageError(
+            "--concatenate stream keeps no buffer, it cannot --memmap")
+
+    weights = {}
+    for option in weight:
+        label, _, value = option.partition("=")
+        try:
+            weights[label] = float(value)
+        except ValueError:
+            raise click.BadParameter("{} is not LABEL=WEIGHT".format(option))
+
     target = get_mediafile(config.session, target)
     mediafiles = [get_mediafile(config.session, mediafile)
                   for mediafile in mediafiles]
@@ -74,21 +250,40 @@ def command(config, output, target, mediafiles, force, select, concatenate,
         mediafiles = config.session.query(MediaFile).filter(not_(
             MediaFile.id == target.id)).all()
 
-    pipeline = Pipeline([
-        UnitGenerator(target, config.session),
-        selection(select, config.session, mediafiles),
-        UnitLoader(
-            hopsize=2048,
-            key=lambda state: state["unit"].mediafile.path),
-        TrimSilence(cutoff=gate),
-        Gain(gain=gain),
-        TimeStretch(),
-        Envelope(fade=fade),
-        SoftClipper(),
+    options = {
+        "select": select,
+        "fade": fade,
+        "gate": gate,
+        "gate_window": gate_window,
+        "gain": gain,
+        "prefetch": prefetch,
+        "snapshot": snapshot,
+        "seed": seed,
+        "normalize": normalize,
+        "weights": weights,
+        "projection": projection
+    }
+
+    if jobs > 1:
+        if concatenate not in ("overlay", "stream"):
+            raise click.UsageError(
+                "--jobs overlays units, it cannot --concatenate {}".format(
+                    concatenate))
+        buff = render(config, target, mediafiles, jobs, memmap, threaded,
+                      options)
+        list(Writer(target, output)([{"mediafile": target, "buffer": buff}]))
+        return
+
+    stages = synthesis(config.session, target, mediafiles, **options)
+    boundary = len(stages) - 1
+    stages.extend([
         ProgressBar(target.units.count()),
-        concatenator(concatenate, target, unit_key="target"),
+        concatenator(concatenate, target, unit_key="target", memmap=memmap),
         Writer(target, output),
         list
     ])
 
+    pipeline = build_pipeline(stages, boundary, threaded=threaded,
+                              profile=config.debug)
     pipeline.run()
+    logger.debug("mosaic pipeline profile\n{}".format(pipeline.summary()))
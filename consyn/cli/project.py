@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014, David Poulter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import unicode_literals
+
+import click
+
+from . import configurator
+from ..commands import fit_projection
+from ..models import MediaFile
+
+
+@click.command("project", short_help="Fit a projection of features.")
+@click.option("--name", default="default", help="Name of the projection.")
+@click.option("--dims", default=8,
+              help="Number of dimensions to project features into.")
+@click.argument("mediafiles", nargs=-1, required=False)
+@configurator
+def command(config, name, dims, mediafiles):
+    ids = None
+    if len(mediafiles) != 0:
+        ids = []
+        for param in mediafiles:
+            mediafile = MediaFile.by_id_or_name(config.session, param)
+            if not mediafile:
+                click.secho("MediaFile {} not found".format(param), fg="red")
+                continue
+            ids.append(mediafile.id)
+
+    projection = fit_projection(config.session, name=name, dims=dims,
+                                mediafiles=ids)
+    config.session.commit()
+    click.secho("Fitted projection {} into {} dimensions".format(
+        projection.name, projection.dims), fg="green")
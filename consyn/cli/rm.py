@@ -18,25 +18,35 @@ from __future__ import unicode_literals
 import click
 
 from . import configurator
-from ..commands import remove_mediafile
+from ..commands import remove_mediafiles
 from ..models import MediaFile
 
 
 @click.command("rm", short_help="Remove mediafles from a database.")
+@click.option("--vacuum", is_flag=True, default=False,
+              help="Rebuild the whole database to reclaim free space.")
 @click.argument("files", nargs=-1)
 @configurator
-def command(config, files):
+def command(config, files, vacuum):
     if len(files) == 1 and files[0] == "all":
-        files = [mediafile.id for mediafile in
-                 config.session.query(MediaFile).all()]
+        remove_mediafiles(config.session)
+    else:
+        mediafiles = []
+        for param in files:
+            mediafile = MediaFile.by_id_or_name(config.session, param)
+            if not mediafile:
+                click.secho("MediaFile {} not found".format(param), fg="red")
+                continue
+            mediafiles.append(mediafile)
 
-    for param in files:
-        mediafile = MediaFile.by_id_or_name(config.session, param)
-        if not mediafile:
-            click.secho("MediaFile {} not found".format(param), fg="red")
-            continue
-
-        remove_mediafile(config.session, mediafile)
+        remove_mediafiles(config.session, mediafiles)
 
     if "sqlite://" in config.database:
-        config.session.execute("VACUUM")
+        if vacuum:
+            config.session.execute("VACUUM")
+        else:
+            # Only reclaims pages in databases created with incremental
+            # auto_vacuum, a page is freed for each row stepped through
+            result = config.session.execute("PRAGMA incremental_vacuum")
+            if result.returns_rows:
+                result.fetchall()
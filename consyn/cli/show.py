@@ -23,14 +23,13 @@ import numpy
 from . import configurator
 from ..base import Pipeline
 from ..concatenators import concatenator
-from ..ext import Analyser
 from ..ext import UnitLoader
 from ..models import MediaFile
 from ..models import Unit
 from ..utils import UnitGenerator
+from ..utils import feature_column
 
 
-FEATURES = len(Analyser())
 TICK_COLOR = "#b9b9b9"
 GRID_COLOR = "#003902"
 WAVE_COLOR = "#00e399"
@@ -77,14 +76,19 @@ def command(config, mediafile, hopsize):
 
     # Features
 
-    figure_feats, axes_feats = plt.subplots(len(FEATURES), sharex=True)
-    features_all = collections.defaultdict(list)
-    timings = []
-    for unit in mediafile.units.order_by(Unit.position) \
-            .filter(Unit.channel == 0):
-        for feature in FEATURES:
-            features_all[feature].append(unit.features[feature])
-        timings.append(unit.position)
+    units = mediafile.units.filter(Unit.channel == 0) \
+        .order_by(Unit.position).all()
+    labels = [label for _, label, _ in units[0].features] if units else []
+    unit_ids = [unit.id for unit in units]
+    timings = [unit.position for unit in units]
+
+    figure_feats, axes_feats = plt.subplots(max(len(labels), 1), sharex=True)
+    if not isinstance(axes_feats, collections.Iterable):
+        axes_feats = [axes_feats]
+
+    features_all = collections.OrderedDict(
+        (label, feature_column(config.session, label, unit_ids))
+        for label in labels)
 
     for index, key in enumerate(features_all):
         axes_feats[index].plot(timings, features_all[key], color=WAVE_COLOR)
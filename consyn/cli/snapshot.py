@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014, David Poulter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import unicode_literals
+import os
+
+import click
+
+from . import configurator
+from ..models import MediaFile
+from ..snapshots import export_snapshot
+
+
+@click.command("snapshot", short_help="Export units and features to arrays.")
+@click.option("--force", is_flag=True, default=False,
+              help="Overwrite the snapshot if it already exists.")
+@click.argument("output")
+@click.argument("mediafiles", nargs=-1, required=False)
+@configurator
+def command(config, output, mediafiles, force):
+    if os.path.exists(output) and not force:
+        click.secho("Snapshot already exists", fg="red")
+        return
+
+    ids = None
+    if len(mediafiles) != 0:
+        ids = []
+        for param in mediafiles:
+            mediafile = MediaFile.by_id_or_name(config.session, param)
+            if not mediafile:
+                click.secho("MediaFile {} not found".format(param), fg="red")
+                continue
+            ids.append(mediafile.id)
+
+    snapshot = export_snapshot(config.session, output, mediafiles=ids)
+    click.secho("Exported {} units to {}".format(len(snapshot), output),
+                fg="green")
@@ -14,30 +14,43 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import unicode_literals
+import collections
 import logging
+import multiprocessing
 import os
 import random
 import time
 
+import numpy
 from sqlalchemy.sql import func
 
 from . import settings
+from .base import ChannelAnalyser
 from .base import Pipeline
+from .base import allocations
 from .ext import Analyser
 from .ext import FileLoader
 from .models import Cluster
+from .models import FeatureSchema
+from .models import FeatureStats
 from .models import Features
 from .models import MediaFile
+from .models import Projection
 from .models import Unit
 from .settings import FEATURE_SLOTS
 from .slicers import slicer
+from .utils import combine_stats
+from .utils import feature_matrix
+from .utils import subtract_stats
 
 
 __all__ = [
     "add_mediafile",
     "get_mediafile",
     "remove_mediafile",
-    "cluster_units"
+    "remove_mediafiles",
+    "cluster_units",
+    "fit_projection"
 ]
 
 
@@ -48,25 +61,103 @@ config = settings.get_settings(__name__, name="add_mediafile")
 def command(fn):
     def wrapped(*args, **kwargs):
         start = time.time()
+        frames = allocations["frames"]
+        buffers = allocations["buffers"]
         logger.debug("{} started".format(fn.__name__))
         result = fn(*args, **kwargs)
         end = time.time()
         logger.debug("{} completed in {} secs".format(
             fn.__name__, end - start))
+        frames = allocations["frames"] - frames
+        buffers = allocations["buffers"] - buffers
+        if frames or buffers:
+            logger.debug("{} allocated {} frames, {} buffers ({:.0f}/sec)"
+                         .format(fn.__name__, frames, buffers,
+                                 (frames + buffers) / max(end - start, 1e-6)))
         return result
     return wrapped
 
 
+def analyse_channels(path, group=0, groups=1, bufsize=1024, hopsize=512,
+                     segmentation="onsets", method="default", threshold=0.3,
+                     silence=-90):
+    """Segment and analyse the channels of an audiofile.
+
+    Returns the units found as dicts, holding the path, samplerate, channel,
+    position, duration and features of each unit.
+
+    Kwargs:
+      path (str): Path to the audiofile
+      group (int): Only analyse channels whose number modulo groups is group
+      groups (int): Number of groups the channels are divided into
+
+    """
+    channels = None
+    if groups > 1:
+        channels = _ChannelGroup(group, groups)
+
+    stages = [
+        FileLoader(path, hopsize=hopsize, reuse_frames=True,
+                   channels=channels),
+        slicer(
+            segmentation,
+            winsize=bufsize,
+            hopsize=hopsize,
+            method=method,
+            threshold=threshold,
+            silence=silence),
+        ChannelAnalyser(lambda: Analyser(winsize=bufsize, hopsize=hopsize))
+    ]
+
+    pipeline = Pipeline(stages, profile=logger.isEnabledFor(logging.DEBUG))
+    units = []
+    for result in pipeline.run():
+        frame = result["frame"]
+        units.append({
+            "path": frame.path,
+            "samplerate": frame.samplerate,
+            "channel": frame.channel,
+            "position": frame.position,
+            "duration": frame.duration,
+            "features": collections.OrderedDict(result["features"].items())
+        })
+
+    if pipeline.profile:
+        logger.debug("analysis pipeline profile\n{}".format(
+            pipeline.summary()))
+    return units
+
+
+class _ChannelGroup(object):
+    """The channels whose number modulo groups is group"""
+
+    def __init__(self, group, groups):
+        self.group = group
+        self.groups = groups
+
+    def __contains__(self, channel):
+        return channel % self.groups == self.group
+
+
+def _analyse_channels(args):
+    path, group, groups, kwargs = args
+    return analyse_channels(path, group=group, groups=groups, **kwargs)
+
+
 @command
 def add_mediafile(session, path, bufsize=int(config.get("bufsize")),
                   hopsize=int(config.get("hopsize")),
                   segmentation=config.get("segmentation"),
                   method=config.get("method"),
                   threshold=float(config.get("threshold")),
-                  silence=float(config.get("silence"))):
+                  silence=float(config.get("silence")),
+                  storage=config.get("storage"),
+                  jobs=1):
     """Add a mediafile to a database.
 
-    Returns the analysed mediafile segmented into units.
+    Returns the analysed mediafile segmented into units, with statistics
+    of their features kept in a FeatureStats, and combined into those of
+    every mediafile.
 
     Kwargs:
       session: Sqlalchemy database session
@@ -75,46 +166,96 @@ def add_mediafile(session, path, bufsize=int(config.get("bufsize")),
       hopsize (int): Hop size to use for analysis.
       method (str): The method to use for onset detection
       threshold (float): The threshold to use for onset detection
+      storage (str): Store features in "columns", or "packed" into a single
+                     value with their labels kept once in a FeatureSchema.
+      jobs (int): Number of processes to segment and analyse channels in,
+                  each process takes every jobs'th channel.
 
     """
-    pipeline = Pipeline([
-        FileLoader(path, hopsize=hopsize),
-        slicer(
-            segmentation,
-            winsize=bufsize,
-            hopsize=hopsize,
-            method=method,
-            threshold=threshold,
-            silence=silence),
-        Analyser(winsize=bufsize, hopsize=hopsize)
-    ])
-
-    results = pipeline.run()
+    kwargs = {
+        "bufsize": bufsize,
+        "hopsize": hopsize,
+        "segmentation": segmentation,
+        "method": method,
+        "threshold": threshold,
+        "silence": silence
+    }
+
+    if jobs > 1:
+        workers = multiprocessing.Pool(jobs)
+        try:
+            groups = workers.map(_analyse_channels, [
+                (path, group, jobs, kwargs) for group in range(jobs)])
+        finally:
+            workers.close()
+            workers.join()
+
+        results = [unit for group in groups for unit in group]
+    else:
+        results = analyse_channels(path, **kwargs)
+
+    results.sort(key=lambda result: (result["position"], result["channel"]))
     mediafile = MediaFile(duration=0, channels=1)
+    schema = None
+
+    if storage == "packed" and len(results) != 0:
+        schema = FeatureSchema.get_or_create(
+            session, list(results[0]["features"].keys()))
+    elif storage != "columns" and storage != "packed":
+        raise ValueError("Unknown feature storage {}".format(storage))
 
+    rows = []
     for index, result in enumerate(results):
-        frame = result["frame"]
+        if schema is not None:
+            rows.append([result["features"][label]
+                         for label in schema.labels])
+        else:
+            row = list(result["features"].values())
+            rows.append(row + [0] * (FEATURE_SLOTS - len(row)))
 
         if index == 0:
-            mediafile.path = os.path.abspath(frame.path)
-            mediafile.samplerate = frame.samplerate
-        if frame.channel == 0:
-            mediafile.duration += frame.duration
-        if frame.channel + 1 > mediafile.channels:
-            mediafile.channels = frame.channel + 1
-
-        unit = Unit(mediafile=mediafile, channel=frame.channel,
-                    position=frame.position, duration=frame.duration)
-        features = Features(result["features"])
+            mediafile.path = os.path.abspath(result["path"])
+            mediafile.samplerate = result["samplerate"]
+        if result["channel"] == 0:
+            mediafile.duration += result["duration"]
+        if result["channel"] + 1 > mediafile.channels:
+            mediafile.channels = result["channel"] + 1
+
+        unit = Unit(mediafile=mediafile, channel=result["channel"],
+                    position=result["position"],
+                    duration=result["duration"])
+        features = Features(result["features"], schema=schema)
         features.unit = unit
         features.mediafile = mediafile
         unit.features = features
         session.add(unit)
 
     session.add(mediafile)
+    if len(rows) != 0:
+        stats = FeatureStats(rows)
+        _add_corpus_stats(session, stats)
+        mediafile.stats = stats
+
     return mediafile
 
 
+def _add_corpus_stats(session, stats):
+    """Combine the statistics of a new mediafile into those of every
+    mediafile, or drop them if they are of features laid out differently."""
+    corpus = FeatureStats.corpus(session)
+    if corpus is None:
+        others = session.query(FeatureStats.id).filter(
+            FeatureStats.mediafile_id.isnot(None)).first()
+        if others is None:
+            corpus = FeatureStats()
+            corpus.store(*stats.arrays)
+            session.add(corpus)
+    elif len(corpus.arrays[1]) == len(stats.arrays[1]):
+        corpus.store(*combine_stats(corpus.arrays, stats.arrays))
+    else:
+        session.delete(corpus)
+
+
 @command
 def get_mediafile(session, parameter):
     """Retrieve a mediafile, adding it with default settings, if not present.
@@ -130,32 +271,93 @@ def get_mediafile(session, parameter):
     return mediafile
 
 
-@command
 def remove_mediafile(session, mediafile):
-    """Remove a mediafile and all records related to it.
+    """Remove a mediafile and all records related to it, see
+    remove_mediafiles, which logs the removal.
 
     Kwargs:
       session: Sqlalchemy database session
       mediafile (MediaFile|int|str): A mediafile object, ID or a filepath
 
     """
-    if not isinstance(mediafile, MediaFile):
-        mediafile = MediaFile.by_id_or_name(session, mediafile)
-    session.query(Features).filter(Features.mediafile == mediafile).delete()
-    session.query(Unit).filter(Unit.mediafile == mediafile).delete()
-    session.delete(mediafile)
+    remove_mediafiles(session, [mediafile])
+
+
+@command
+def remove_mediafiles(session, mediafiles=None, chunksize=500):
+    """Remove mediafiles and all records related to them, in bulk.
+
+    Records are deleted with a statement per table and chunk of mediafiles,
+    and committed once. Returns the number of mediafiles removed.
+
+    Kwargs:
+      session: Sqlalchemy database session
+      mediafiles (list): Mediafile objects, IDs or filepaths, or None to
+                         remove every mediafile
+      chunksize (int): Number of mediafiles to delete per statement
+
+    """
+    if mediafiles is None:
+        session.query(Features).delete(synchronize_session=False)
+        session.query(FeatureStats).delete(synchronize_session=False)
+        session.query(Unit).delete(synchronize_session=False)
+        count = session.query(MediaFile).delete(synchronize_session=False)
+        session.commit()
+        return count
+
+    ids = []
+    for mediafile in mediafiles:
+        if not isinstance(mediafile, MediaFile):
+            mediafile = MediaFile.by_id_or_name(session, mediafile)
+        if mediafile is not None:
+            ids.append(mediafile.id)
+
+    corpus = FeatureStats.corpus(session)
+    count = 0
+    for start in range(0, len(ids), chunksize):
+        chunk = ids[start:start + chunksize]
+        if corpus is not None:
+            for stats in session.query(FeatureStats).filter(
+                    FeatureStats.mediafile_id.in_(chunk)):
+                corpus.store(*subtract_stats(corpus.arrays, stats.arrays))
+        session.query(Features).filter(Features.mediafile_id.in_(chunk)) \
+            .delete(synchronize_session=False)
+        session.query(FeatureStats) \
+            .filter(FeatureStats.mediafile_id.in_(chunk)) \
+            .delete(synchronize_session=False)
+        session.query(Unit).filter(Unit.mediafile_id.in_(chunk)) \
+            .delete(synchronize_session=False)
+        count += session.query(MediaFile).filter(MediaFile.id.in_(chunk)) \
+            .delete(synchronize_session=False)
+
+    if corpus is not None and corpus.count == 0:
+        session.delete(corpus)
+
     session.commit()
+    return count
 
 
 @command
-def cluster_units(session, clusters, max_iterations=10000):
+def cluster_units(session, clusters, max_iterations=10000, projection=None):
     """Cluster all units. Returns the number of iterations
 
     Kwargs:
       session: Sqlalchemy database session
       clusters (int): Number of clusters
+      projection (str|Projection): Cluster the features of units in memory,
+                                   projected by a projection or the name of
+                                   one, see fit_projection
+
+    Packed features have no columns to cluster in the database, so they are
+    always clustered in memory.
 
     """
+    packed = session.query(Features.id).filter(
+        Features.vector.isnot(None)).first()
+    if projection is not None or packed is not None:
+        return _cluster_matrix(session, clusters, max_iterations,
+                               projection)
+
     random_pks = random.sample(
         xrange(session.query(Unit).count() - 2), clusters)
     random_features = [session.query(Unit).get(pk + 1).features
@@ -234,3 +436,108 @@ def cluster_units(session, clusters, max_iterations=10000):
             break
 
     return iterations
+
+
+def _cluster_matrix(session, clusters, max_iterations, projection=None):
+    """Cluster the features of all units in memory with k-means, using the
+    manhattan distance like cluster_units, optionally projected."""
+    if projection is not None and not isinstance(projection, Projection):
+        name = projection
+        projection = Projection.by_name(session, name)
+        if projection is None:
+            raise ValueError("Projection {} not found".format(name))
+
+    mediafiles = [mediafile for (mediafile,) in session.query(MediaFile.id)]
+    ids, matrix = feature_matrix(session, mediafiles)
+    points = matrix
+    if projection is not None:
+        points = projection.transform(matrix)
+    centers = points[random.sample(xrange(len(ids)), clusters)]
+
+    assignments = None
+    iterations = 0
+    while True:
+        # A center at a time, so only a distance per unit is kept
+        nearest = numpy.zeros(len(points), dtype="int64")
+        closest = numpy.empty(len(points), dtype="float64")
+        closest.fill(numpy.inf)
+        for index, center in enumerate(centers):
+            distances = numpy.abs(points - center).sum(axis=1)
+            closer = distances < closest
+            closest[closer] = distances[closer]
+            nearest[closer] = index
+        iterations += 1
+
+        if assignments is not None and (nearest == assignments).all():
+            break
+        assignments = nearest
+
+        for index in xrange(clusters):
+            members = points[assignments == index]
+            if members.shape[0] != 0:
+                centers[index] = members.mean(axis=0)
+
+        if iterations == max_iterations:
+            break
+
+    # Centroids are kept as features, not projected
+    session.query(Cluster).delete()
+    rows = []
+    for index in xrange(clusters):
+        cluster = Cluster()
+        members = matrix[assignments == index]
+        if members.shape[0] != 0:
+            for slot, value in enumerate(members.mean(axis=0)):
+                setattr(cluster, "feat_{}".format(slot), float(value))
+        session.add(cluster)
+        rows.append(cluster)
+    session.flush()
+
+    for index, cluster in enumerate(rows):
+        units = [int(unit) for unit in ids[assignments == index]]
+        for start in xrange(0, len(units), 500):
+            session.query(Features).filter(
+                Features.unit_id.in_(units[start:start + 500])).update(
+                {"cluster": cluster.id}, synchronize_session=False)
+
+    session.commit()
+    return iterations
+
+
+@command
+def fit_projection(session, name="default", dims=8, mediafiles=None):
+    """Fit a projection of features into fewer dimensions to the units of
+    mediafiles, by principal component analysis.
+
+    Returns the projection, which replaces any of the same name.
+
+    Kwargs:
+      session: Sqlalchemy database session
+      name (str): Name of the projection
+      dims (int): Number of dimensions to project features into
+      mediafiles (list): IDs of the mediafiles, all by default
+
+    """
+    if mediafiles is None:
+        mediafiles = [mediafile for (mediafile,) in
+                      session.query(MediaFile.id)]
+
+    _, matrix = feature_matrix(session, mediafiles)
+    if matrix.shape[0] == 0:
+        raise ValueError("No features to fit a projection to")
+
+    matrix = matrix.astype("float64")
+    mean = matrix.mean(axis=0)
+    std = matrix.std(axis=0)
+    scale = 1 / numpy.where(std > 0, std, 1)
+    _, _, components = numpy.linalg.svd((matrix - mean) * scale,
+                                        full_matrices=False)
+
+    existing = Projection.by_name(session, name)
+    if existing is not None:
+        session.delete(existing)
+        session.flush()
+
+    projection = Projection(name, mean, scale, components[:dims])
+    session.add(projection)
+    return projection
@@ -13,22 +13,39 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import tempfile
+
 import numpy
 
 from .base import Stage
 from .settings import DTYPE
+from .settings import get_settings
 from .utils import factory
 
 
 __all__ = ["concatenator"]
 
 
-class BaseConcatenator(Stage):
+settings = get_settings(__name__)
+
 
-    def __init__(self, mediafile, unit_key="unit"):
+class BaseConcatenator(Stage):
+    """Base class for building a mosaic from a stream of units.
+
+    Kwargs:
+      unit_key (str): Key of the unit in the context to position samples by
+      memmap (bool): Keep the buffer in a memory mapped temporary file, this
+                     is also done for buffers larger than the memmap_threshold
+                     setting (in bytes). The file is made in the memmap_dir
+                     setting, or the default temporary directory, which may
+                     be held in memory itself.
+
+    """
+    def __init__(self, mediafile, unit_key="unit", memmap=False):
         super(BaseConcatenator, self).__init__()
         self.mediafile = mediafile
         self.unit_key = unit_key
+        self.memmap = memmap
         self.buffer = self.initialize_buffer(self.mediafile)
 
     def __call__(self, pipe):
@@ -38,12 +55,25 @@ class BaseConcatenator(Stage):
 
         yield {
             "mediafile": self.mediafile,
-            "buffer": self.buffer
+            "buffer": self.get_buffer()
         }
 
+    def get_buffer(self):
+        return self.buffer
+
     def initialize_buffer(self, mediafile):
-        return numpy.zeros(
-            (mediafile.channels, mediafile.duration), dtype=DTYPE)
+        return self.allocate((mediafile.channels, mediafile.duration))
+
+    def allocate(self, shape):
+        size = int(numpy.prod(shape)) * numpy.dtype(DTYPE).itemsize
+        threshold = settings.get("memmap_threshold")
+
+        if size > 0 and (self.memmap or (threshold and size > threshold)):
+            # The file is unlinked once closed, the mapping stays valid
+            directory = settings.get("memmap_dir") or None
+            with tempfile.TemporaryFile(prefix="consyn", dir=directory) as fp:
+                return numpy.memmap(fp, dtype=DTYPE, mode="w+", shape=shape)
+        return numpy.zeros(shape, dtype=DTYPE)
 
     def concatenate(self, target, samples):
         raise NotImplementedError("Concatenators must implement this")
@@ -73,25 +103,139 @@ class ClipConcatenator(BaseConcatenator):
 
 
 class OverlayConcatenator(ClipConcatenator):
+    """Overlay units on each other, keeping units that overrun the target.
+
+    The buffer grows when a unit runs past its end, by at least half its
+    length so growing is rare, and the mosaic is extended to fit.
+
+    Kwargs:
+      headroom (int): Number of samples to allocate past the end of the target
+
+    """
+    def __init__(self, mediafile, unit_key="unit", memmap=False,
+                 headroom=0):
+        self.headroom = headroom
+        super(OverlayConcatenator, self).__init__(
+            mediafile, unit_key=unit_key, memmap=memmap)
+        self.length = mediafile.duration
+
+    def initialize_buffer(self, mediafile):
+        return self.allocate(
+            (mediafile.channels, mediafile.duration + self.headroom))
+
+    def get_buffer(self):
+        return self.buffer[:, :self.length]
+
+    def overlay(self, position, buff):
+        """Add a region of samples for every channel at position."""
+        end = position + buff.shape[1]
+        if end > self.buffer.shape[1]:
+            self.grow(end)
+
+        self.buffer[:, position:end] += buff
+        self.length = max(self.length, end)
 
     def concatenate(self, target, samples):
         start = target.position
         end = target.position + samples.shape[0]
-        try:
-            self.buffer[target.channel][start:end] += samples
-        except ValueError:
-            # FIXME: Extend buffer instead of trimming samples
-            end = target.position + target.duration
-            self.buffer[target.channel][start:end] += self.clip_samples(
-                samples, target.duration)
+
+        if end > self.buffer.shape[1]:
+            self.grow(end)
+
+        self.buffer[target.channel][start:end] += samples
+        self.length = max(self.length, end)
+
+    def grow(self, length):
+        length = max(length, self.buffer.shape[1] + self.buffer.shape[1] // 2)
+        buff = self.allocate((self.buffer.shape[0], length))
+        buff[:, :self.length] = self.buffer[:, :self.length]
+        self.buffer = buff
 
 
 class StackConcatenator(BaseConcatenator):
     pass
 
 
+class StreamingConcatenator(BaseConcatenator):
+    """Overlay units, passing on regions of the mosaic as they are finished.
+
+    Units must arrive ordered by position. Only the region that the units
+    still to come can overlap is kept in memory, everything before the
+    position of the latest unit is passed down the pipeline in pieces. As
+    with the OverlayConcatenator, units that overrun the target are kept.
+
+    Kwargs:
+      start (int): Position of the first region passed on
+      end (int): Position the last region reaches at least, defaults to the
+                 duration of the target
+
+    """
+    def __init__(self, mediafile, unit_key="unit", start=0, end=None):
+        super(StreamingConcatenator, self).__init__(
+            mediafile, unit_key=unit_key)
+        self.end = mediafile.duration if end is None else end
+        self.offset = start
+        self.length = 0
+
+    def __call__(self, pipe):
+        for pool in pipe:
+            target = pool[self.unit_key]
+            if target.position > self.offset:
+                result = self.flush(target.position)
+                if result is not None:
+                    yield result
+            self.concatenate(target, pool["frame"].samples)
+
+        result = self.flush(max(self.end, self.offset + self.length))
+        if result is not None:
+            yield result
+
+    def initialize_buffer(self, mediafile):
+        return numpy.zeros((mediafile.channels, 0), dtype=DTYPE)
+
+    def concatenate(self, target, samples):
+        start = target.position - self.offset
+        if start < 0:
+            raise ValueError("Units must be ordered by position")
+
+        end = start + samples.shape[0]
+        if end > self.buffer.shape[1]:
+            buff = numpy.zeros((self.buffer.shape[0],
+                                max(end, self.buffer.shape[1] * 2)),
+                               dtype=DTYPE)
+            buff[:, :self.length] = self.buffer[:, :self.length]
+            self.buffer = buff
+
+        self.buffer[target.channel][start:end] += samples
+        self.length = max(self.length, end)
+
+    def flush(self, position):
+        """Pass on the finished samples before position."""
+        amount = position - self.offset
+        if amount <= 0:
+            return None
+
+        used = min(amount, self.length)
+        buff = numpy.zeros((self.buffer.shape[0], amount), dtype=DTYPE)
+        buff[:, :used] = self.buffer[:, :used]
+
+        remaining = self.length - used
+        self.buffer[:, :remaining] = self.buffer[:, used:self.length]
+        self.buffer[:, remaining:self.length] = 0
+        self.length = remaining
+
+        result = {
+            "mediafile": self.mediafile,
+            "buffer": buff,
+            "position": self.offset
+        }
+        self.offset = position
+        return result
+
+
 def concatenator(name, *args, **kwargs):
     objects = {"clip": ClipConcatenator,
                "overlay": OverlayConcatenator,
-               "stack": StackConcatenator}
+               "stack": StackConcatenator,
+               "stream": StreamingConcatenator}
     return factory(objects, name, *args, **kwargs)
@@ -16,6 +16,7 @@
 from __future__ import unicode_literals
 import collections
 import logging
+import threading
 
 import aubio
 import numpy
@@ -24,10 +25,12 @@ from ..base import AnalysisStage
 from ..base import AudioFrame
 from ..base import FileLoaderStage
 from ..base import Stage
+from ..base import allocations
 from ..base import UnitLoaderStage
 from ..settings import DTYPE
 from ..settings import get_settings
 from ..slicers import BaseSlicer
+from ..utils import RegionCache
 from ..utils import slice_array
 
 
@@ -48,39 +51,66 @@ class AubioFileCache(object):
 
     _soundfiles = {}
     _counts = {}
+    _positions = {}
+    _lock = threading.RLock()
 
     def open(self, path, hopsize):
         if path not in self._soundfiles:
             soundfile = aubio.source(path.encode("utf-8"), 0, hopsize)
             self._soundfiles[path] = soundfile
+            self._positions[path] = 0
+            # Sources read into the same buffer every hop
+            allocations.add("buffers")
             self._counts[path] = 0
         if len(self._soundfiles) > settings.get("max_open_files"):
+            # Close the least used source, other than the one being opened
             minimum = float("inf")
             min_path = None
-            for path in self._counts:
-                if minimum > self._counts[path]:
-                    minimum = self._counts[path]
-                    min_path = path
+            for other in self._counts:
+                if other != path and minimum > self._counts[other]:
+                    minimum = self._counts[other]
+                    min_path = other
             self._close(min_path)
 
         self._counts[path] += 1
         return self._soundfiles[path]
 
-    def close(self):
-        for path in self._soundfiles.keys():
+    def seek(self, path, hopsize, position):
+        """Open a source, positioned to read from position.
+
+        After a seek, aubio's own wav reader first hands out what was left
+        of its previous read, so the samples read would depend on the order
+        units are read in. Instead of seeking a source that has been read
+        from, it is opened again, unless it is already at position.
+
+        """
+        soundfile = self.open(path, hopsize)
+        if self._positions[path] == position:
+            return soundfile
+
+        if self._positions[path] != 0:
             self._close(path)
+            soundfile = self.open(path, hopsize)
+        soundfile.seek(position)
+        self._positions[path] = position
+        return soundfile
+
+    def close(self):
+        with self._lock:
+            for path in self._soundfiles.keys():
+                self._close(path)
 
     def _close(self, path):
         self._soundfiles[path].close()
         del self._soundfiles[path]
         del self._counts[path]
+        del self._positions[path]
 
 
 class AubioFileLoader(FileLoaderStage, AubioFileCache):
 
     def read(self, path):
-        soundfile = self.open(path, self.hopsize)
-        soundfile.seek(0)
+        soundfile = self.seek(path, self.hopsize, 0)
 
         index = 0
         positions = {}
@@ -92,21 +122,21 @@ class AubioFileLoader(FileLoaderStage, AubioFileCache):
                 break
 
             for channel, samples in enumerate(channels):
+                if not self.selected(channel):
+                    continue
+
                 if channel not in positions:
                     positions[channel] = 0
 
-                frame = AudioFrame()
-                frame.samplerate = soundfile.samplerate
-                frame.position = positions[channel]
-                frame.channel = channel
-                frame.samples = samples[:read]
-                frame.duration = read
-                frame.index = index
-                frame.path = path
+                frame = self.get_frame(samples[:read], soundfile.samplerate,
+                                       positions[channel], channel, index,
+                                       path, read)
 
                 positions[channel] += read
                 yield frame
 
+            self._positions[path] += read
+
             index += 1
             if read < soundfile.hop_size:
                 break
@@ -114,36 +144,49 @@ class AubioFileLoader(FileLoaderStage, AubioFileCache):
 
 class AubioUnitLoader(UnitLoaderStage, AubioFileCache):
 
+    def __init__(self, hopsize=1024, key=lambda context: context["path"]):
+        super(AubioUnitLoader, self).__init__(hopsize=hopsize, key=key)
+        self.regions = RegionCache()
+
     def read(self, path, unit):
-        soundfile = self.open(path, self.hopsize)
-        soundfile.seek(unit.position)
+        # Sources are shared between loaders, which may be reading from
+        # different threads (see PrefetchUnitLoader)
+        with self._lock:
+            samples = self.regions.get(path, unit)
+            if samples is None:
+                buff = self.decode(path, unit)
+                self.regions.put(path, unit, buff)
+                samples = buff[unit.channel]
+            samplerate = self.open(path, self.hopsize).samplerate
+
+        yield AudioFrame(samples, samplerate, unit.position, unit.channel, 0,
+                         path, unit.duration)
+
+    def decode(self, path, unit):
+        soundfile = self.seek(path, self.hopsize, unit.position)
 
         pos = 0
-        buff = numpy.zeros(unit.duration, dtype=DTYPE)
+        buff = None
 
         while True:
             channels, read = soundfile.do_multi()
-            samples = channels[unit.channel]
+            self._positions[path] += read
+
+            if buff is None:
+                buff = numpy.zeros((len(channels), unit.duration),
+                                   dtype=DTYPE)
+                allocations.add("buffers")
 
             if read + pos > unit.duration:
                 read = unit.duration - pos
 
-            buff[pos:pos + read] = samples[:read]
+            buff[:, pos:pos + read] = channels[:, :read]
             pos += read
 
             if pos >= unit.duration or read == 0:
                 break
 
-        frame = AudioFrame()
-        frame.samplerate = soundfile.samplerate
-        frame.position = unit.position
-        frame.channel = unit.channel
-        frame.samples = buff
-        frame.duration = unit.duration
-        frame.index = 0
-        frame.path = path
-
-        yield frame
+        return buff
 
 
 class AubioAnalyser(AnalysisStage):
@@ -241,20 +284,21 @@ class AubioWriter(Stage):
         self.mediafile = mediafile
 
     def __call__(self, pipe):
-        for pool in pipe:
-            framesize = 2048
-            buff = pool["buffer"]
+        framesize = 2048
+        sink = None
 
-            sink = aubio.sink(self.outfile, 0, self.mediafile.channels)
-            out_samples = numpy.array_split(
-                buff, int(float(self.mediafile.duration) / int(framesize)),
-                axis=1)
+        # Buffers may be the whole mosaic, or consecutive pieces of it
+        for pool in pipe:
+            if sink is None:
+                sink = aubio.sink(self.outfile, 0, self.mediafile.channels)
 
-            for frame in out_samples:
-                amount = frame[0].shape[0]
-                sink.do_multi(frame, amount)
+            buff = pool["buffer"]
+            for start in range(0, buff.shape[1], framesize):
+                frame = numpy.ascontiguousarray(
+                    buff[:, start:start + framesize])
+                sink.do_multi(frame, frame.shape[1])
 
+        if sink is not None:
             sink.close()
             del sink
-
             yield {"out": self.outfile}
@@ -23,6 +23,8 @@ from ..base import AudioFrame
 from ..base import FileLoaderStage
 from ..base import Stage
 from ..base import UnitLoaderStage
+from ..base import allocations
+from ..utils import RegionCache
 from ..utils import slice_array
 
 
@@ -82,6 +84,7 @@ class LibrosaFileLoader(FileLoaderStage):
 
     def read(self, path):
         samples, samplerate = librosa.load(path, sr=None, mono=False)
+        allocations.add("buffers")
         size = len(samples.shape)
         channels = 1
 
@@ -89,6 +92,9 @@ class LibrosaFileLoader(FileLoaderStage):
             channels = samples.shape[0]
 
         for channel in xrange(channels):
+            if not self.selected(channel):
+                continue
+
             position = 0
 
             if channels > 1:
@@ -101,14 +107,8 @@ class LibrosaFileLoader(FileLoaderStage):
             for index, block in enumerate(blocks):
                 duration = block.shape[0]
 
-                frame = AudioFrame()
-                frame.samplerate = samplerate
-                frame.position = position
-                frame.channel = channel
-                frame.samples = block
-                frame.duration = duration
-                frame.index = index
-                frame.path = path
+                frame = self.get_frame(block, samplerate, position, channel,
+                                       index, path, duration)
 
                 position += duration
                 yield frame
@@ -116,28 +116,36 @@ class LibrosaFileLoader(FileLoaderStage):
 
 class LibrosaUnitLoader(UnitLoaderStage):
 
+    def __init__(self, hopsize=1024, key=lambda context: context["path"]):
+        super(LibrosaUnitLoader, self).__init__(hopsize=hopsize, key=key)
+        self.regions = RegionCache()
+
     def read(self, path, unit):
         if not unit.mediafile:
             samplerate = 44100.0
         else:
             samplerate = float(unit.mediafile.samplerate)
 
+        frame = AudioFrame(self.regions.get(path, unit), samplerate,
+                           unit.position, unit.channel, 0, path,
+                           unit.duration)
+
+        if frame.samples is not None:
+            yield frame
+            return
+
         start = float(unit.position) / samplerate
         duration = float(unit.duration) / samplerate
 
         samples, samplerate = librosa.load(path, sr=samplerate, mono=False,
                                            offset=start, duration=duration)
-        frame = AudioFrame()
+        allocations.add("buffers")
         frame.samplerate = samplerate
-        frame.position = unit.position
-        frame.channel = unit.channel
-        frame.duration = unit.duration
-        frame.index = 0
-        frame.path = path
 
         if len(samples.shape) == 1:
             frame.samples = samples
         else:
+            self.regions.put(path, unit, samples)
             frame.samples = samples[unit.channel]
 
         yield frame
@@ -151,8 +159,12 @@ class LibrosaWriter(Stage):
         self.mediafile = mediafile
 
     def __call__(self, pipe):
-        for pool in pipe:
-            buff = numpy.transpose(pool["buffer"])
-            librosa.output.write_wav(self.outfile, buff,
-                                     self.mediafile.samplerate)
-            yield {"out": self.outfile}
+        # Buffers may be the whole mosaic, or consecutive pieces of it
+        buffers = [pool["buffer"] for pool in pipe]
+        if len(buffers) == 0:
+            return
+
+        buff = numpy.transpose(numpy.concatenate(buffers, axis=1))
+        librosa.output.write_wav(self.outfile, buff,
+                                 self.mediafile.samplerate)
+        yield {"out": self.outfile}
@@ -16,21 +16,49 @@
 from __future__ import unicode_literals
 import os
 
+import numpy
 from sqlalchemy import Column
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
 from sqlalchemy import Integer
+from sqlalchemy import LargeBinary
 from sqlalchemy import Table
 from sqlalchemy import UnicodeText
+from sqlalchemy import inspect
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm.exc import NoResultFound
 
+from .settings import DTYPE
 from .settings import FEATURE_SLOTS
 from .settings import FEATURE_TYPE
 
 
 Base = declarative_base()
 
+# Label to slot mappings, shared by all features with the same labels
+_label_slots = {}
+
+
+def label_slots(labels):
+    """Map each label to its slot, the index of the first slot holding it.
+
+    Mappings are shared, so the result must not be modified.
+
+    Args:
+      labels (list): The label of each slot, None for empty slots
+
+    """
+    labels = tuple(labels)
+    slots = _label_slots.get(labels)
+    if slots is None:
+        slots = {}
+        for slot, label in enumerate(labels):
+            if label is not None:
+                slots.setdefault(label, slot)
+        _label_slots[labels] = slots
+    return slots
+
 
 class MediaFile(Base):
     """A file containing audio samples.
@@ -41,6 +69,7 @@ class MediaFile(Base):
       channels (int): The number of audio channels in the file.
       samplerate (int): The samplerate of the audio file.
       duration (int): Duration of the file in samples
+      stats (FeatureStats): Statistics of the features of its units
 
     """
     __tablename__ = "mediafiles"
@@ -52,6 +81,7 @@ class MediaFile(Base):
 
     units = relationship("Unit", backref="mediafile", lazy="dynamic")
     features = relationship("Features", backref="mediafile", lazy="dynamic")
+    stats = relationship("FeatureStats", uselist=False, backref="mediafile")
 
     @property
     def name(self):
@@ -73,7 +103,11 @@ class MediaFile(Base):
     def __repr__(self):
         keys = ["id", "name", "duration", "channels", "samplerate"]
         values = ["{}={}".format(key, getattr(self, key)) for key in keys]
-        values.append("units={}".format(self.units.count()))
+        # Units are counted in memory before a mediafile is added to a
+        # session, with a COUNT on the units index after, and can not be
+        # counted at all once it is detached from its session
+        if not inspect(self).detached:
+            values.append("units={}".format(self.units.count()))
         return "<MediaFile({})>".format(", ".join(values))
 
     def __str__(self):
@@ -92,6 +126,11 @@ class Unit(Base):
 
     """
     __tablename__ = "units"
+    __table_args__ = (
+        # Also serves lookups by mediafile alone
+        Index("ix_units_mediafile_channel_position",
+              "mediafile_id", "channel", "position"),
+    )
     id = Column(Integer, primary_key=True)
     mediafile_id = Column(Integer, ForeignKey("mediafiles.id"))
     channel = Column(Integer, nullable=False)
@@ -121,45 +160,134 @@ class Cluster(Base):
               for feature in range(FEATURE_SLOTS))))
 
 
+class FeatureSchema(Base):
+    """The labels of packed features, stored once for all units analysed
+    the same way.
+
+    Attributes:
+      id (int): Unique ID.
+      names (str): The labels of the features, one per line.
+
+    """
+    __tablename__ = "feature_schemas"
+    id = Column(Integer, primary_key=True)
+    names = Column(UnicodeText, nullable=False, unique=True)
+
+    @property
+    def labels(self):
+        return self.names.split("\n")
+
+    @property
+    def slots(self):
+        """Mapping of labels to their index in the packed values."""
+        if getattr(self, "_slots", None) is None:
+            self._slots = label_slots(self.labels)
+        return self._slots
+
+    @classmethod
+    def get_or_create(cls, session, labels):
+        names = "\n".join(labels)
+        schema = session.query(cls).filter_by(names=names).first()
+        if schema is None:
+            schema = cls(names=names)
+            session.add(schema)
+        return schema
+
+    def __repr__(self):
+        return "<FeatureSchema(id={}, labels={})>".format(
+            self.id, len(self.labels))
+
+
 class Features(Base):
     """The extracted audible characteristics of a unit of sound.
 
+    Features are stored either in columns, a feat_* and label_* column for
+    each feature, or packed, as a single array of values whose labels are
+    held by a schema. The columns of packed features are left NULL.
+
     Attributes:
       id (int): Unique identifier for the set of features.
       unit (Unit): The unit the set of features describes.
       mediafile (MediaFile): The mediafile the set of features is part of.
       feat_* (float): The value of the feature.
       label_* (str): The human readable name of the feature.
+      schema (FeatureSchema): The labels of packed features.
+      vector (bytes): Packed feature values.
 
     """
     __table__ = Table(
         "features", Base.metadata,
         Column("id", Integer, primary_key=True),
-        Column("unit_id", Integer, ForeignKey("units.id")),
-        Column("mediafile_id", Integer, ForeignKey("mediafiles.id")),
+        Column("unit_id", Integer, ForeignKey("units.id"), index=True),
+        Column("mediafile_id", Integer, ForeignKey("mediafiles.id"),
+               index=True),
         Column("cluster", Integer, nullable=True, default=0, index=True),
-        *list((Column("feat_{}".format(feature), FEATURE_TYPE, nullable=True,
-               default=0)
+        Column("schema_id", Integer, ForeignKey("feature_schemas.id"),
+               nullable=True),
+        Column("vector", LargeBinary, nullable=True),
+        *list((Column("feat_{}".format(feature), FEATURE_TYPE, nullable=True)
               for feature in range(FEATURE_SLOTS))) +
         list((Column("label_{}".format(feature), UnicodeText(32),
               nullable=True)
               for feature in range(FEATURE_SLOTS))))
 
-    def __init__(self, features):
-        if features:
+    schema = relationship("FeatureSchema")
+
+    def __init__(self, features, schema=None):
+        if features and schema is not None:
+            self.schema = schema
+            self.vector = numpy.array(
+                [features[label] for label in schema.labels],
+                dtype=DTYPE).tobytes()
+        elif features:
             assert len(features) <= FEATURE_SLOTS
             for index, (label, feature) in enumerate(features.items()):
                 setattr(self, "label_{}".format(index), label)
                 setattr(self, "feat_{}".format(index), feature)
+            for index in range(len(features), FEATURE_SLOTS):
+                setattr(self, "feat_{}".format(index), 0)
+
+    @property
+    def packed(self):
+        return self.vector is not None
+
+    @property
+    def array(self):
+        """The feature values as an array, one value per slot or label."""
+        if self.packed:
+            return numpy.frombuffer(self.vector, dtype=DTYPE)
+        return numpy.array([getattr(self, "feat_{}".format(index))
+                            for index in range(FEATURE_SLOTS)], dtype=DTYPE)
+
+    @property
+    def slots(self):
+        """Mapping of labels to the slots holding their features."""
+        if self.packed:
+            return self.schema.slots
+
+        # Rows are not updated once analysed, so the mapping is kept
+        slots = getattr(self, "_slots", None)
+        if slots is None:
+            slots = label_slots(getattr(self, "label_{}".format(index))
+                                for index in range(FEATURE_SLOTS))
+            self._slots = slots
+        return slots
 
     def __getitem__(self, name):
-        for index in range(FEATURE_SLOTS):
-            label = getattr(self, "label_{}".format(index))
-            if label == name:
-                return getattr(self, "feat_{}".format(index))
-        raise Exception("{} not found".format(name))
+        slot = self.slots.get(name)
+        if slot is None:
+            raise Exception("{} not found".format(name))
+        if self.packed:
+            return self.array[slot]
+        return getattr(self, "feat_{}".format(slot))
 
     def __iter__(self):
+        if self.packed:
+            values = self.array
+            for index, label in enumerate(self.schema.labels):
+                yield (index, label, values[index])
+            return
+
         for index in range(FEATURE_SLOTS):
             label = getattr(self, "label_{}".format(index))
             if label is None:
@@ -174,3 +302,140 @@ class Features(Base):
 
     def __str__(self):
         return self.__repr__()
+
+
+class FeatureStats(Base):
+    """The mean and variance of the features of the units of a mediafile,
+    kept so features can be normalised without reading every unit.
+
+    Statistics are laid out like the rows of features, one per slot or
+    label. The row without a mediafile holds the statistics of the units
+    of every mediafile with a row, see combine_stats and subtract_stats.
+
+    Attributes:
+      id (int): Unique ID.
+      mediafile (MediaFile): The mediafile the statistics are of.
+      count (int): Number of units.
+      mean (bytes): Packed mean of each feature.
+      m2 (bytes): Packed sum of the squared deviations of each feature
+                  from its mean.
+
+    """
+    __tablename__ = "feature_stats"
+    id = Column(Integer, primary_key=True)
+    mediafile_id = Column(Integer, ForeignKey("mediafiles.id"), unique=True,
+                          index=True)
+    count = Column(Integer, nullable=False)
+    mean = Column(LargeBinary, nullable=False)
+    m2 = Column(LargeBinary, nullable=False)
+
+    def __init__(self, matrix=None):
+        if matrix is not None:
+            matrix = numpy.asarray(matrix, dtype="float64")
+            mean = matrix.mean(axis=0)
+            self.store(matrix.shape[0], mean,
+                       ((matrix - mean) ** 2).sum(axis=0))
+
+    @property
+    def arrays(self):
+        """The count, mean and m2 as a tuple of arrays."""
+        return (self.count, numpy.frombuffer(self.mean, dtype="float64"),
+                numpy.frombuffer(self.m2, dtype="float64"))
+
+    def store(self, count, mean, m2):
+        self.count = int(count)
+        self.mean = numpy.asarray(mean, dtype="float64").tobytes()
+        self.m2 = numpy.asarray(m2, dtype="float64").tobytes()
+
+    @classmethod
+    def corpus(cls, session):
+        """The row holding the statistics of every mediafile, if any."""
+        return session.query(cls).filter(cls.mediafile_id.is_(None)).first()
+
+    def __repr__(self):
+        return "<FeatureStats(mediafile={}, count={})>".format(
+            self.mediafile_id, self.count)
+
+
+class Projection(Base):
+    """A projection of features into fewer dimensions, fitted to the
+    features of a corpus by principal component analysis.
+
+    Features are standardised before being projected, so the components
+    are not dominated by features with large ranges.
+
+    Attributes:
+      id (int): Unique ID.
+      name (str): Unique name of the projection.
+      dims (int): Number of dimensions projected into.
+      mean (bytes): Packed mean of each feature.
+      scale (bytes): Packed factor to standardise each feature by.
+      components (bytes): Packed components, a row for each dimension.
+
+    """
+    __tablename__ = "projections"
+    id = Column(Integer, primary_key=True)
+    name = Column(UnicodeText(32), nullable=False, unique=True)
+    dims = Column(Integer, nullable=False)
+    mean = Column(LargeBinary, nullable=False)
+    scale = Column(LargeBinary, nullable=False)
+    components = Column(LargeBinary, nullable=False)
+
+    def __init__(self, name, mean, scale, components):
+        self.name = unicode(name)
+        self.dims = components.shape[0]
+        self.mean = numpy.asarray(mean, dtype=DTYPE).tobytes()
+        self.scale = numpy.asarray(scale, dtype=DTYPE).tobytes()
+        self.components = numpy.asarray(components, dtype=DTYPE).tobytes()
+
+    @property
+    def arrays(self):
+        """The mean, scale and components as arrays."""
+        if getattr(self, "_arrays", None) is None:
+            mean = numpy.frombuffer(self.mean, dtype=DTYPE)
+            scale = numpy.frombuffer(self.scale, dtype=DTYPE)
+            components = numpy.frombuffer(self.components, dtype=DTYPE)
+            self._arrays = (mean, scale, components.reshape(self.dims, -1))
+        return self._arrays
+
+    @property
+    def features(self):
+        """Number of features projected from."""
+        return self.arrays[0].shape[0]
+
+    def transform(self, features):
+        """Project a row of features, or a matrix with a row per unit."""
+        mean, scale, components = self.arrays
+        return ((features - mean) * scale).dot(components.T).astype(DTYPE)
+
+    @classmethod
+    def by_name(cls, session, name):
+        try:
+            return session.query(cls).filter_by(name=unicode(name)).one()
+        except NoResultFound:
+            return None
+
+    def __repr__(self):
+        return "<Projection(name={}, dims={})>".format(self.name, self.dims)
+
+
+def migrate(engine):
+    """Add the columns and indexes missing from tables created by earlier
+    versions."""
+    inspector = inspect(engine)
+    existing = set(column["name"]
+                   for column in inspector.get_columns("features"))
+
+    with engine.begin() as connection:
+        for column in Features.__table__.columns:
+            if column.name in existing:
+                continue
+            connection.execute("ALTER TABLE features ADD COLUMN {} {}".format(
+                column.name, column.type.compile(dialect=engine.dialect)))
+
+        for table in Base.metadata.sorted_tables:
+            indexes = set(index["name"]
+                          for index in inspector.get_indexes(table.name))
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(connection)
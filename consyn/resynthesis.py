@@ -14,13 +14,18 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import unicode_literals
+import threading
 
 import numpy
 
 from .base import SynthesisStage
+from .base import allocations
 
 
 __all__ = [
+    "Workspace",
+    "workspace",
+    "Chain",
     "Gain",
     "Envelope",
     "TimeStretch",
@@ -29,6 +34,82 @@ __all__ = [
 ]
 
 
+class Workspace(threading.local):
+    """Windows, ramps and scratch buffers shared by resynthesis stages.
+
+    Arrays are cached by size and reused across units, each thread has its
+    own workspace. Windows and ramps must not be modified, scratch buffers
+    are only valid until the next request for the same name.
+
+    """
+    def __init__(self):
+        super(Workspace, self).__init__()
+        self.arrays = {}
+
+    def window(self, size):
+        key = ("window", size)
+        if key not in self.arrays:
+            self.arrays[key] = numpy.hanning(size)
+            allocations.add("buffers")
+        return self.arrays[key]
+
+    def ramp(self, size, rising=True):
+        key = ("ramp", size, rising)
+        if key not in self.arrays:
+            if rising:
+                self.arrays[key] = numpy.linspace(0.0, 1.0, num=size)
+            else:
+                self.arrays[key] = numpy.linspace(1.0, 0.0, num=size)
+            allocations.add("buffers")
+        return self.arrays[key]
+
+    def arange(self, size):
+        key = ("arange", size)
+        if key not in self.arrays:
+            self.arrays[key] = numpy.arange(size)
+            allocations.add("buffers")
+        return self.arrays[key]
+
+    def scratch(self, name, shape, dtype="float64"):
+        """Returns a zeroed buffer of shape, from a pooled allocation."""
+        size = int(numpy.prod(shape))
+        key = ("scratch", name, numpy.dtype(dtype).str)
+        buff = self.arrays.get(key)
+        if buff is None or buff.shape[0] < size:
+            buff = numpy.empty(max(size, 1), dtype=dtype)
+            self.arrays[key] = buff
+            allocations.add("buffers")
+
+        buff = buff[:size].reshape(shape)
+        buff.fill(0)
+        return buff
+
+
+workspace = Workspace()
+
+
+class Chain(SynthesisStage):
+    """Apply several synthesis stages to each unit, as a single stage.
+
+    Each stage processes the samples left by the previous one, in place where
+    it can, and the context is only updated once per unit.
+
+    Args:
+      stages (list): The SynthesisStages to apply in order
+
+    """
+    def __init__(self, stages):
+        super(Chain, self).__init__()
+        self.stages = stages
+
+    def process(self, samples, unit, target):
+        for stage in self.stages:
+            samples, unit = stage.process(samples, unit, target)
+            if samples.shape[0] == 0:
+                break
+        return samples, unit
+
+
 class Gain(SynthesisStage):
 
     def __init__(self, gain=1.0):
@@ -36,7 +117,9 @@ class Gain(SynthesisStage):
         self.gain = float(gain)
 
     def process(self, samples, unit, target):
-        return samples * self.gain, unit
+        if self.gain != 1.0:
+            samples *= self.gain
+        return samples, unit
 
 
 class Envelope(SynthesisStage):
@@ -44,19 +127,20 @@ class Envelope(SynthesisStage):
     def __init__(self, fade=30):
         super(Envelope, self).__init__()
         self.fade = fade
-        self.attack = numpy.linspace(0.0, 1.0, num=fade)
-        self.decay = numpy.linspace(1.0, 0.0, num=fade)
 
     def process(self, samples, unit, target):
-        samples[0:self.fade] *= self.attack
-        samples[-self.fade:] *= self.decay
+        # Units shorter than two fades get a fade of half their length
+        fade = min(self.fade, samples.shape[0] // 2)
+        if fade > 0:
+            samples[:fade] *= workspace.ramp(fade)
+            samples[-fade:] *= workspace.ramp(fade, rising=False)
         return samples, unit
 
 
 class SoftClipper(SynthesisStage):
 
     def process(self, samples, unit, target):
-        samples = numpy.tanh(samples)
+        numpy.tanh(samples, out=samples)
         return samples, unit
 
 
@@ -78,65 +162,130 @@ class TimeStretch(SynthesisStage):
 
         hopsize = int(float(self.winsize) / float(self.overlap))
         duration = len(samples)
+        length = int(float(duration) / float(factor) + self.winsize)
+
+        if duration == 0:
+            return samples, unit
+
+        # Analysis frames start every hopsize * factor samples, each is paired
+        # with the frame one hop later to measure the phase advance. Starts
+        # are summed one step at a time, then truncated, so they round the
+        # same way as a running position would.
+        limit = duration - (self.winsize + hopsize)
+        steps = max(int(numpy.ceil(limit / float(hopsize * factor))), 0) + 2
+        positions = workspace.scratch("positions", (steps,))
+        positions[1:] = hopsize * factor
+        numpy.cumsum(positions, out=positions)
+        frames = int(numpy.searchsorted(positions, limit))
+
+        starts = workspace.scratch("starts", (frames, 1), dtype="int64")
+        starts[:, 0] = positions[:frames]
+        indices = workspace.scratch(
+            "indices", (frames, self.winsize), dtype="int64")
+        numpy.add(starts, workspace.arange(self.winsize), out=indices)
+
+        # Windowed frames are gathered into scratch buffers, numpy.fft has no
+        # out argument, so each transform allocates its result
+        window = workspace.window(self.winsize)
+        taken = workspace.scratch(
+            "taken", (frames, self.winsize), dtype=samples.dtype)
+        windowed = workspace.scratch("windowed", (frames, self.winsize))
+
+        numpy.take(samples, indices, out=taken, mode="clip")
+        numpy.multiply(taken, window, out=windowed)
+        spec1 = numpy.fft.rfft(windowed, axis=1)
+
+        indices += hopsize
+        numpy.take(samples, indices, out=taken, mode="clip")
+        numpy.multiply(taken, window, out=windowed)
+        spec2 = numpy.fft.rfft(windowed, axis=1)
+
+        # The phase advances of each frame are accumulated, and given the
+        # magnitude of the later frame, reusing the buffer of spec1
+        bins = spec2.shape[1]
+        phi = workspace.scratch("phi", (frames, bins))
+        other = workspace.scratch("other", (frames, bins))
+        numpy.arctan2(spec2.imag, spec2.real, out=phi)
+        numpy.arctan2(spec1.imag, spec1.real, out=other)
+        numpy.subtract(phi, other, out=phi)
+        numpy.cumsum(phi, axis=0, out=phi)
+
+        numpy.abs(spec2, out=other)
+        numpy.cos(phi, out=spec1.real)
+        numpy.sin(phi, out=spec1.imag)
+        spec1.real *= other
+        spec1.imag *= other
+
+        # Overlap-add the grains, each block of hopsize samples in a grain
+        # lands on consecutive hops of the output
+        blocks = int(numpy.ceil(float(self.winsize) / hopsize))
+        grains = workspace.scratch("grains", (frames, blocks * hopsize))
+        grains[:, :self.winsize] = numpy.fft.irfft(
+            spec1, n=self.winsize, axis=1)
+        grains[:, :self.winsize] *= window
+        grains = grains.reshape(frames, blocks, hopsize)
+
+        sigout = workspace.scratch(
+            "sigout", (max(length, (frames + blocks) * hopsize),))
+        for block in range(blocks):
+            start = block * hopsize
+            hops = sigout[start:start + frames * hopsize]
+            hops.shape = (frames, hopsize)
+            hops += grains[:, block]
+        sigout = sigout[:length]
+
+        amp = samples.max()
+        max_samp = sigout.max()
 
-        phi = numpy.zeros(self.winsize)
-        out = numpy.zeros(self.winsize, dtype=complex)
-        sigout = numpy.zeros(
-            int(float(duration) / float(factor) + self.winsize))
-        window = numpy.hanning(self.winsize)
-
-        amp = max(samples)
-        pos1 = 0
-        pos2 = 0
+        if max_samp != 0:
+            amp = amp / max_samp
 
-        while pos2 < duration - (self.winsize + hopsize):
-            position = int(pos2)
+        output = numpy.empty(length, dtype="float32")
+        numpy.multiply(sigout, amp, out=output)
+        allocations.add("buffers")
 
-            spec1 = numpy.fft.fft(window * samples[
-                position:position + self.winsize])
+        return output, unit
 
-            spec2 = numpy.fft.fft(window * samples[
-                position + hopsize:position + self.winsize + hopsize])
 
-            phi += (numpy.angle(spec2) - numpy.angle(spec1))
+class TrimSilence(SynthesisStage):
+    """Remove silence from the start and end of a unit.
 
-            out.real = numpy.cos(phi)
-            out.imag = numpy.sin(phi)
+    Kwargs:
+      cutoff (float): Level at or below which samples are silent
+      trim (str): Trim the front ("f"), the back ("b") or both ("fb")
+      window (int): Gate on the RMS level of windows of this many samples,
+                    rather than on the level of each sample
 
-            sigout[pos1:pos1 + self.winsize] += (
-                window * numpy.fft.ifft(abs(spec2) * out)).real
-            pos1 += hopsize
-            pos2 += hopsize * factor
+    """
+    def __init__(self, cutoff=0, trim="fb", window=None):
+        self.cutoff = cutoff
+        self.trim = trim
+        self.window = window
 
-        max_samp = max(sigout)
+    def process(self, samples, unit, target):
+        duration = samples.shape[0]
+        step = self.window or 1
 
-        if max_samp != 0:
-            sigout = numpy.array(amp * sigout / max_samp, dtype="float32")
+        if step == 1:
+            loud = numpy.abs(samples) > self.cutoff
         else:
-            sigout = numpy.array(amp * sigout, dtype="float32")
-
-        return sigout, unit
+            starts = numpy.arange(0, duration, step)
+            if starts.shape[0] == 0:
+                return samples, unit
+            power = numpy.add.reduceat(samples * samples, starts)
+            power /= numpy.diff(numpy.append(starts, duration))
+            loud = numpy.sqrt(power) > self.cutoff
 
+        if not loud.any():
+            return samples[0:0], unit
 
-class TrimSilence(SynthesisStage):
+        start = 0
+        end = duration
 
-    def __init__(self, cutoff=0, trim="fb"):
-        self.cutoff = cutoff
-        self.trim = trim
-
-    def process(self, samples, unit, target):
         if "f" in self.trim:
-            temporary = numpy.empty_like(samples)
-            temporary[:] = samples
-            temporary[numpy.abs(samples) <= self.cutoff] = 0
-            temporary = numpy.trim_zeros(temporary, trim="f")
-            samples = samples[samples.shape[0] - temporary.shape[0]:]
-
+            start = int(loud.argmax()) * step
         if "b" in self.trim:
-            temporary = numpy.empty_like(samples)
-            temporary[:] = samples
-            temporary[numpy.abs(temporary) <= self.cutoff] = 0
-            temporary = numpy.trim_zeros(temporary, trim="b")
-            samples = samples[0:temporary.shape[0]]
+            end = min((loud.shape[0] - int(loud[::-1].argmax())) * step,
+                      duration)
 
-        return samples, unit
+        return samples[start:end], unit
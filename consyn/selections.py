@@ -15,24 +15,49 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """Unit selection algorithms"""
 from __future__ import unicode_literals
-import random
 
+import numpy
 from sqlalchemy.sql import func
 
 from .base import SelectionStage
 from .models import Features
+from .models import Projection
 from .models import Unit
+from .settings import DTYPE
 from .settings import FEATURE_SLOTS
+from .snapshots import Snapshot
+from .snapshots import load_snapshot
 from .utils import factory
+from .utils import feature_matrix
+from .utils import feature_stats
 
 
 __all__ = ["selection"]
 
 
 class NearestNeighbour(SelectionStage):
-    """Retrieve the nearest unit using the manhattan distance"""
+    """Retrieve the nearest unit using the manhattan distance, measured by
+    the database. Packed features have no columns to measure, so when the
+    target or the corpus is packed they are measured in memory instead, see
+    MatrixNearestNeighbour.
+
+    """
+    def __init__(self, session, mediafiles):
+        super(NearestNeighbour, self).__init__(session, mediafiles)
+        self.corpus = mediafiles
+        self.matrix = None
+        packed = session.query(Features.id).filter(
+            Features.mediafile_id.in_(self.mediafiles),
+            Features.vector.isnot(None)).first()
+        if packed is not None:
+            self.matrix = MatrixNearestNeighbour(session, mediafiles)
+
     def select(self, unit):
         target_features = unit.features
+        if self.matrix is None and target_features.packed:
+            self.matrix = MatrixNearestNeighbour(self.session, self.corpus)
+        if self.matrix is not None:
+            return self.matrix.select(unit)
 
         dist_func = func.abs(Features.feat_0 - target_features.feat_0)
 
@@ -48,14 +73,154 @@ class NearestNeighbour(SelectionStage):
         return self.session.query(Unit).get(pk)
 
 
+class MatrixNearestNeighbour(SelectionStage):
+    """Retrieve the nearest unit using the manhattan distance, measured
+    against the features of every unit loaded into memory once.
+
+    Works with features stored in columns or packed, see Features.
+
+    Kwargs:
+      snapshot (str|Snapshot): Load features from a snapshot, or the path
+                               of one, instead of the database
+      normalize (bool): Divide each feature by its standard deviation over
+                        the units of the mediafiles, see FeatureStats
+      weights (dict): Multiply the distance of features by a weight, keyed
+                      by their label. Other features have a weight of 1.
+      projection (str|Projection): Measure distances between features
+                                   projected into fewer dimensions, by a
+                                   projection or the name of one. Features
+                                   are standardised by the projection, so
+                                   it excludes normalize and weights.
+
+    """
+    def __init__(self, session, mediafiles, snapshot=None, normalize=False,
+                 weights=None, projection=None):
+        super(MatrixNearestNeighbour, self).__init__(session, mediafiles)
+        if snapshot is None:
+            self.ids, self.matrix = feature_matrix(session, self.mediafiles)
+        else:
+            if not isinstance(snapshot, Snapshot):
+                snapshot = load_snapshot(snapshot)
+            if not snapshot.matches(session, self.mediafiles):
+                raise ValueError("Units have been added or removed since "
+                                 "the snapshot, export it again")
+            snapshot = snapshot.select(self.mediafiles)
+            self.ids, self.matrix = snapshot.units, snapshot.features
+
+        # Features in columns fill every slot, packed features only theirs
+        self.width = self.matrix.shape[1]
+        self.scale = None
+        self.projection = None
+        if projection is not None:
+            if normalize or weights:
+                raise ValueError("Projected features are already scaled")
+            if not isinstance(projection, Projection):
+                name = projection
+                projection = Projection.by_name(session, name)
+                if projection is None:
+                    raise ValueError("Projection {} not found".format(name))
+            if projection.features != self.matrix.shape[1]:
+                raise ValueError("Projection is of {} features, not {}"
+                                 .format(projection.features,
+                                         self.matrix.shape[1]))
+            self.projection = projection
+            self.matrix = projection.transform(self.matrix)
+        elif normalize or weights:
+            self.scale = self.scaling(normalize, weights or {})
+            self.matrix = self.matrix * self.scale
+
+    def scaling(self, normalize, weights):
+        """The factor to multiply each feature by."""
+        scale = numpy.ones(self.matrix.shape[1], dtype=DTYPE)
+
+        if normalize:
+            stats = feature_stats(self.session, self.mediafiles)
+            if stats is None:
+                std = self.matrix.std(axis=0)
+            else:
+                _, std = stats
+            scale /= numpy.where(std > 0, std, 1)
+
+        if len(weights) != 0:
+            features = self.session.query(Features).filter(
+                Features.mediafile_id.in_(self.mediafiles)).first()
+            for label, weight in weights.items():
+                slot = features.slots.get(label)
+                if slot is None:
+                    raise ValueError("{} not found".format(label))
+                scale[slot] *= weight
+
+        return scale
+
+    def select(self, unit):
+        target = unit.features.array
+        if target.shape[0] != self.width:
+            row = numpy.zeros(self.width, dtype=DTYPE)
+            size = min(self.width, target.shape[0])
+            row[:size] = target[:size]
+            target = row
+        if self.projection is not None:
+            target = self.projection.transform(target)
+        elif self.scale is not None:
+            target = target * self.scale
+        distances = numpy.abs(self.matrix - target).sum(axis=1)
+        pk = int(self.ids[distances.argmin()])
+        return self.session.query(Unit).get(pk)
+
+
 class RandomUnit(SelectionStage):
+    """Retrieve a unit of the mediafiles at random.
+
+    The IDs of the units to choose from are loaded once, then units are
+    drawn and fetched from the database in batches.
+
+    Kwargs:
+      seed (int): Seed for the random number generator
+      batch (int): Number of units to draw at a time
+
+    """
+    def __init__(self, session, mediafiles, seed=None, batch=256):
+        super(RandomUnit, self).__init__(session, mediafiles)
+        self.random = numpy.random.RandomState(seed)
+        self.batch = batch
+        self.ids = numpy.array([pk for (pk,) in session.query(Unit.id).filter(
+            Unit.mediafile_id.in_(self.mediafiles)).order_by(Unit.id)],
+            dtype="int64")
+        if len(self.ids) == 0:
+            raise ValueError("No units to select from")
+
+    def __call__(self, pipe):
+        contexts = []
+        for context in pipe:
+            contexts.append(context)
+            if len(contexts) == self.batch:
+                for context in self.select_many(contexts):
+                    yield context
+                contexts = []
+
+        for context in self.select_many(contexts):
+            yield context
+
+    def select_many(self, contexts):
+        if len(contexts) == 0:
+            return contexts
+
+        ids = [int(pk) for pk in self.random.choice(self.ids, len(contexts))]
+        units = {unit.id: unit for unit in self.session.query(Unit).filter(
+            Unit.id.in_(set(ids)))}
+
+        for context, pk in zip(contexts, ids):
+            context["target"] = context["unit"]
+            context["unit"] = units[pk]
+        return contexts
 
     def select(self, unit):
-        count = self.session.query(Unit).count()
-        return self.session.query(Unit).get(random.randint(1, count - 1))
+        return self.session.query(Unit).get(
+            int(self.random.choice(self.ids)))
 
 
 def selection(name, *args, **kwargs):
     objects = {"nearest": NearestNeighbour,
+               "matrix": MatrixNearestNeighbour,
                "random": RandomUnit}
     return factory(objects, name, *args, **kwargs)
@@ -36,6 +36,14 @@ bufsize = 1024
 hopsize = 512
 database = {0}
 max_open_files = 50
+memmap_threshold = 0
+memmap_dir =
+sqlite_auto_vacuum = INCREMENTAL
+sqlite_journal_mode = WAL
+sqlite_synchronous = NORMAL
+sqlite_cache_size = -65536
+sqlite_mmap_size = 268435456
+sqlite_temp_store = MEMORY
 
 [consyn.commands:add_mediafile]
 segmentation = onsets
@@ -45,6 +53,7 @@ segmentation = onsets
 method = default
 threshold = 0.3
 silence = -90
+storage = columns
 
 """.format(os.path.join(APP_DIR, "consyn.sqlite"))
 
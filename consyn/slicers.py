@@ -19,6 +19,7 @@ from __future__ import unicode_literals
 import numpy
 
 from .base import AudioFrame
+from .base import allocations
 from .base import SegmentationStage
 from .settings import DTYPE
 from .utils import factory
@@ -32,7 +33,8 @@ class Segmentor(object):
     def __init__(self, channel, detector):
         self.channel = channel
         self.detector = detector
-        self.buffer = numpy.array([], dtype=DTYPE)
+        self.buffer = numpy.zeros(0, dtype=DTYPE)
+        self.length = 0
         self.onsets = []
         self.position = 0
 
@@ -40,9 +42,37 @@ class Segmentor(object):
         keys = ["position", "onsets", "channel"]
         values = ["{}={}".format(key, getattr(self, key)) for key in keys
                   if hasattr(self, key)]
-        values.append("buffer={}".format(self.buffer.shape[0]))
+        values.append("buffer={}".format(self.length))
         return "<Segmentor({})>".format(", ".join(values))
 
+    @property
+    def samples(self):
+        return self.buffer[:self.length]
+
+    def append(self, samples):
+        """Copy samples onto the end of the buffer, growing it if needed."""
+        length = self.length + samples.shape[0]
+        if length > self.buffer.shape[0]:
+            buff = numpy.zeros(max(length, self.buffer.shape[0] * 2),
+                               dtype=DTYPE)
+            buff[:self.length] = self.buffer[:self.length]
+            self.buffer = buff
+            allocations.add("buffers")
+
+        self.buffer[self.length:length] = samples
+        self.length = length
+
+    def consume(self, duration):
+        """Remove and return samples from the start of the buffer."""
+        duration = min(duration, self.length)
+        samples = self.buffer[:duration].copy()
+        allocations.add("buffers")
+
+        remaining = self.length - duration
+        self.buffer[:remaining] = self.buffer[duration:self.length]
+        self.length = remaining
+        return samples
+
 
 class BaseSlicer(SegmentationStage):
 
@@ -62,7 +92,7 @@ class BaseSlicer(SegmentationStage):
 
         segment = self.channels[frame.channel]
         segment.position = frame.position + frame.duration
-        segment.buffer = numpy.concatenate((segment.buffer, frame.samples))
+        segment.append(frame.samples)
 
         if segment.detector(frame.samples):
             position = self.get_onset_position(segment)
@@ -81,18 +111,10 @@ class BaseSlicer(SegmentationStage):
             if len(segment.onsets) == 0:
                 segment.onsets.append(segment.position)
 
-            samples = segment.buffer
-            duration = samples.shape[0]
-            position = segment.onsets[0]
-
-            frame = AudioFrame()
-            frame.samplerate = self.samplerate
-            frame.path = self.path
-            frame.samples = samples
-            frame.channel = segment.channel
-            frame.position = position
-            frame.duration = duration
-            yield frame
+            samples = segment.samples
+            yield AudioFrame(samples, self.samplerate, segment.onsets[0],
+                             segment.channel, None, self.path,
+                             samples.shape[0])
 
     def get_detector(self):
         raise NotImplementedError()
@@ -102,20 +124,12 @@ class BaseSlicer(SegmentationStage):
 
     def flush(self, segment):
         duration = segment.onsets[1] - segment.onsets[0]
-        samples = segment.buffer[:duration]
+        samples = segment.consume(duration)
         position = segment.onsets[0]
-
-        segment.buffer = segment.buffer[duration:]
         segment.onsets = [segment.onsets[1]]
 
-        frame = AudioFrame()
-        frame.samplerate = self.samplerate
-        frame.path = self.path
-        frame.samples = samples
-        frame.channel = segment.channel
-        frame.position = position
-        frame.duration = duration
-        return frame
+        return AudioFrame(samples, self.samplerate, position, segment.channel,
+                          None, self.path, duration)
 
 
 class RegularDetector(object):
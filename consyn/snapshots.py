@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014, David Poulter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Columnar snapshots of the units of a database and their features"""
+from __future__ import unicode_literals
+import os
+
+import numpy
+from sqlalchemy.sql import func
+
+from .models import Features
+from .models import MediaFile
+from .models import Unit
+from .utils import feature_matrix
+
+
+__all__ = [
+    "Snapshot",
+    "export_snapshot",
+    "load_snapshot"
+]
+
+
+# Arrays of a snapshot, each saved to a .npy file of the same name
+ARRAYS = [
+    "units",
+    "mediafiles",
+    "channels",
+    "positions",
+    "durations",
+    "features",
+    "labels",
+    "fingerprint"
+]
+
+# Arrays holding a row per unit
+UNIT_ARRAYS = [
+    "units",
+    "mediafiles",
+    "channels",
+    "positions",
+    "durations",
+    "features"
+]
+
+
+class Snapshot(object):
+    """The units of a corpus and their features, as columns of arrays.
+
+    Kwargs:
+      units (ndarray): IDs of the units
+      mediafiles (ndarray): The mediafile ID of each unit
+      channels (ndarray): The channel of each unit
+      positions (ndarray): The position of each unit
+      durations (ndarray): The duration of each unit
+      features (ndarray): A row of features for each unit
+      labels (ndarray): The labels of the features, one for each of the
+                        leading columns
+      fingerprint (ndarray): The ID, unit count and greatest unit ID of each
+                             mediafile, to tell when the snapshot is stale
+
+    """
+    def __init__(self, units, mediafiles, channels, positions, durations,
+                 features, labels, fingerprint):
+        self.units = units
+        self.mediafiles = mediafiles
+        self.channels = channels
+        self.positions = positions
+        self.durations = durations
+        self.features = features
+        self.labels = labels
+        self.fingerprint = fingerprint
+
+    def __len__(self):
+        return self.units.shape[0]
+
+    def matches(self, session, mediafiles):
+        """Whether the units of some mediafiles in the database are still
+        those of the snapshot, none having been added or removed since.
+
+        Compares the fingerprint against a single aggregate query, rather
+        than reading the ID of every unit.
+
+        Args:
+          session: Sqlalchemy database session
+          mediafiles (list): IDs of the mediafiles
+
+        """
+        current = numpy.array(sorted(session.query(
+            Features.mediafile_id, func.count(Features.unit_id),
+            func.max(Features.unit_id)).filter(
+            Features.mediafile_id.in_(mediafiles)).group_by(
+            Features.mediafile_id)), dtype="int64").reshape(-1, 3)
+
+        saved = self.fingerprint[numpy.in1d(self.fingerprint[:, 0],
+                                            numpy.asarray(mediafiles))]
+        saved = saved[numpy.argsort(saved[:, 0])]
+        return numpy.array_equal(current, saved)
+
+    def select(self, mediafiles):
+        """A snapshot of only the units of some mediafiles.
+
+        Args:
+          mediafiles (list): IDs of the mediafiles
+
+        """
+        rows = numpy.in1d(self.mediafiles, numpy.asarray(mediafiles))
+        if rows.all():
+            return self
+
+        arrays = {name: getattr(self, name) for name in ARRAYS}
+        for name in UNIT_ARRAYS:
+            arrays[name] = arrays[name][rows]
+        arrays["fingerprint"] = self.fingerprint[numpy.in1d(
+            self.fingerprint[:, 0], numpy.asarray(mediafiles))]
+        return Snapshot(**arrays)
+
+    def save(self, path):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in ARRAYS:
+            numpy.save(os.path.join(path, "{}.npy".format(name)),
+                       getattr(self, name))
+
+
+def export_snapshot(session, path, mediafiles=None):
+    """Write a snapshot of units and their features to a directory.
+
+    Returns the snapshot.
+
+    Args:
+      session: Sqlalchemy database session
+      path (str): Directory to write the snapshot to
+
+    Kwargs:
+      mediafiles (list): IDs of the mediafiles to include, all by default
+
+    """
+    if mediafiles is None:
+        mediafiles = [mediafile for (mediafile,) in
+                      session.query(MediaFile.id)]
+
+    ids, matrix = feature_matrix(session, mediafiles)
+
+    rows = numpy.zeros((len(ids), 4), dtype="int64")
+    if len(ids) != 0:
+        units = numpy.array(session.query(
+            Unit.id, Unit.mediafile_id, Unit.channel, Unit.position,
+            Unit.duration).filter(Unit.mediafile_id.in_(mediafiles)).all(),
+            dtype="int64")
+        units = units[numpy.argsort(units[:, 0])]
+        rows = units[numpy.searchsorted(units[:, 0], ids), 1:]
+
+    labels = []
+    if len(ids) != 0:
+        features = session.query(Features).filter(
+            Features.unit_id == int(ids[0])).one()
+        labels = [label for _, label, _ in features]
+
+    snapshot = Snapshot(
+        units=ids,
+        mediafiles=rows[:, 0].copy(),
+        channels=rows[:, 1].copy(),
+        positions=rows[:, 2].copy(),
+        durations=rows[:, 3].copy(),
+        features=matrix,
+        labels=numpy.array(labels, dtype="unicode"),
+        fingerprint=_fingerprint(ids, rows[:, 0]))
+
+    snapshot.save(path)
+    return snapshot
+
+
+def _fingerprint(units, mediafiles):
+    """The ID, unit count and greatest unit ID of each mediafile."""
+    ids, inverse = numpy.unique(mediafiles, return_inverse=True)
+    greatest = numpy.zeros(len(ids), dtype="int64")
+    numpy.maximum.at(greatest, inverse, units)
+    return numpy.column_stack([
+        ids, numpy.bincount(inverse, minlength=len(ids)), greatest]).astype(
+        "int64").reshape(-1, 3)
+
+
+def load_snapshot(path, mmap=True):
+    """Load a snapshot written by export_snapshot.
+
+    Args:
+      path (str): Directory the snapshot was written to
+
+    Kwargs:
+      mmap (bool): Map the arrays from their files, rather than read them
+
+    """
+    mode = "r" if mmap else None
+    arrays = {name: numpy.load(os.path.join(path, "{}.npy".format(name)),
+                               mmap_mode=mode)
+              for name in ARRAYS}
+    return Snapshot(**arrays)
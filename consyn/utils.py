@@ -14,29 +14,107 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import unicode_literals
+import collections
 import inspect
 
+import numpy
+from sqlalchemy import case
+from sqlalchemy.orm import joinedload
+
 from .base import Stage
+from .models import FeatureSchema
+from .models import FeatureStats
+from .models import Features
+from .models import Unit
+from .settings import DTYPE
+from .settings import FEATURE_SLOTS
 
 
 __all__ = [
+    "RegionCache",
     "UnitGenerator",
+    "feature_column",
+    "feature_matrix",
+    "feature_stats",
     "slice_array"
 ]
 
 
 class UnitGenerator(Stage):
+    """Generate the units of a mediafile, ordered by position.
+
+    Kwargs:
+      start (int): Only generate units at or after this position
+      end (int): Only generate units before this position
+      batch (int): Number of units to fetch from the database at a time
 
-    def __init__(self, mediafile, session):
+    """
+    def __init__(self, mediafile, session, start=None, end=None,
+                 batch=1000):
         super(UnitGenerator, self).__init__()
         self.mediafile = mediafile
         self.session = session
+        self.start = start
+        self.end = end
+        self.batch = batch
 
     def __call__(self, *args):
-        for unit in self.mediafile.units:
+        units = self.session.query(Unit).options(
+            joinedload(Unit.features),
+            joinedload(Unit.mediafile)).filter(
+            Unit.mediafile == self.mediafile)
+        if self.start is not None:
+            units = units.filter(Unit.position >= self.start)
+        if self.end is not None:
+            units = units.filter(Unit.position < self.end)
+
+        units = units.order_by(Unit.position, Unit.channel)
+        for unit in units.yield_per(self.batch):
             yield {"unit": unit}
 
 
+class RegionCache(object):
+    """Decoded regions of media files, kept for sibling units.
+
+    Units that share a mediafile and position but not a channel are
+    siblings. Decoders read every channel of a region at once, so the
+    channels not asked for are kept here until a sibling unit is read.
+    Each channel is handed out only once, as stages further down the
+    pipeline are free to modify samples in place.
+
+    Kwargs:
+      size (int): Maximum number of regions to keep
+
+    """
+    def __init__(self, size=32):
+        self.size = size
+        self.regions = collections.OrderedDict()
+
+    def get(self, path, unit):
+        key = (path, unit.position)
+        if key not in self.regions:
+            return None
+
+        channels = self.regions[key]
+        samples = channels.pop(unit.channel, None)
+        if len(channels) == 0:
+            del self.regions[key]
+
+        if samples is None or samples.shape[0] < unit.duration:
+            return None
+        return samples[:unit.duration]
+
+    def put(self, path, unit, channels):
+        siblings = {channel: samples for channel, samples
+                    in enumerate(channels) if channel != unit.channel}
+        if len(siblings) == 0:
+            return
+
+        self.regions[(path, unit.position)] = siblings
+        while len(self.regions) > self.size:
+            self.regions.popitem(last=False)
+
+
 def slice_array(arr, bufsize=1024, hopsize=512):
     position = 0
     duration = arr.shape[0]
@@ -64,3 +142,199 @@ def factory(objects, name, *args, **kwargs):
 
     kwargs = {key: kwargs[key] for key in kargs if key in kwargs}
     return Class(*args, **kwargs)
+
+
+def feature_matrix(session, mediafiles):
+    """Load the features of the units of mediafiles into a matrix.
+
+    Returns an array of unit ids, and a matrix with a row of features for
+    each of those units. Packed features are read with a single frombuffer,
+    features stored in columns fill every slot. When both are present, as
+    after the storage setting changes, rows in columns are cut down to the
+    packed features, which must have the same labels.
+
+    Args:
+      session: Sqlalchemy database session
+      mediafiles (list): IDs of the mediafiles
+
+    """
+    if len(mediafiles) == 0:
+        return (numpy.zeros(0, dtype="int64"),
+                numpy.zeros((0, FEATURE_SLOTS), dtype=DTYPE))
+
+    packed = session.query(
+        Features.unit_id, Features.schema_id, Features.vector).filter(
+        Features.mediafile_id.in_(mediafiles),
+        Features.vector.isnot(None)).order_by(Features.unit_id).all()
+
+    columns = session.query(
+        Features.unit_id,
+        *[getattr(Features, "feat_{}".format(slot))
+          for slot in range(FEATURE_SLOTS)]).filter(
+        Features.mediafile_id.in_(mediafiles),
+        Features.vector.is_(None)).order_by(Features.unit_id).all()
+
+    ids = numpy.array([row[0] for row in columns], dtype="int64")
+    matrix = numpy.array([row[1:] for row in columns], dtype=DTYPE)
+    matrix = matrix.reshape(len(ids), FEATURE_SLOTS)
+    if len(packed) == 0:
+        return ids, matrix
+
+    schemas = set(schema for _, schema, _ in packed)
+    if len(schemas) != 1:
+        raise ValueError("Packed features have different schemas")
+    packed_ids = numpy.array([unit for unit, _, _ in packed], dtype="int64")
+    vectors = numpy.frombuffer(
+        b"".join(vector for _, _, vector in packed), dtype=DTYPE)
+    vectors = vectors.reshape(len(packed_ids), -1)
+    if len(ids) == 0:
+        return packed_ids, vectors
+
+    labels = session.query(
+        *[getattr(Features, "label_{}".format(slot))
+          for slot in range(FEATURE_SLOTS)]).filter(
+        Features.mediafile_id.in_(mediafiles),
+        Features.vector.is_(None)).distinct().all()
+    schema = session.query(FeatureSchema).get(schemas.pop())
+    if len(labels) != 1 or [label for label in labels[0]
+                            if label is not None] != schema.labels:
+        raise ValueError("Features are stored both packed and in columns, "
+                         "with different labels")
+
+    ids = numpy.concatenate([packed_ids, ids])
+    matrix = numpy.concatenate([vectors, matrix[:, :vectors.shape[1]]])
+    order = numpy.argsort(ids, kind="mergesort")
+    return ids[order], matrix[order]
+
+
+def combine_stats(first, second):
+    """Combine the count, mean and m2 of two sets of units into those of
+    both, with the parallel formula of Chan et al."""
+    count1, mean1, m2_1 = first
+    count2, mean2, m2_2 = second
+    count = count1 + count2
+    if count == 0:
+        return 0, numpy.zeros_like(mean1), numpy.zeros_like(m2_1)
+
+    delta = mean2 - mean1
+    mean = mean1 + delta * (float(count2) / count)
+    m2 = m2_1 + m2_2 + delta ** 2 * (float(count1) * count2 / count)
+    return count, mean, m2
+
+
+def subtract_stats(total, part):
+    """Remove the count, mean and m2 of part of a set of units from those
+    of the whole set, the inverse of combine_stats."""
+    count1, mean1, m2_1 = total
+    count2, mean2, m2_2 = part
+    count = count1 - count2
+    if count <= 0:
+        return 0, numpy.zeros_like(mean1), numpy.zeros_like(m2_1)
+
+    mean = mean1 - (mean2 - mean1) * (float(count2) / count)
+    delta = mean2 - mean
+    m2 = m2_1 - m2_2 - delta ** 2 * (float(count) * count2 / count1)
+    return count, mean, numpy.maximum(m2, 0)
+
+
+def feature_stats(session, mediafiles):
+    """Combine the feature statistics of mediafiles.
+
+    Returns the mean and standard deviation of each feature of the units
+    of the mediafiles, or None if any of them have no statistics, as
+    mediafiles added by earlier versions do not, or their features are
+    laid out differently. When the mediafiles hold
+    most units, the statistics of the others are subtracted from those of
+    every mediafile instead, so fewer rows are read.
+
+    Args:
+      session: Sqlalchemy database session
+      mediafiles (list): IDs of the mediafiles
+
+    """
+    if len(mediafiles) == 0:
+        return None
+
+    mediafiles = set(mediafiles)
+    counts = session.query(FeatureStats.mediafile_id, FeatureStats.count) \
+        .filter(FeatureStats.mediafile_id.isnot(None)).all()
+    included = [(pk, count) for pk, count in counts if pk in mediafiles]
+    if len(included) != len(mediafiles):
+        return None
+
+    excluded = [pk for pk, count in counts if pk not in mediafiles]
+    total = sum(count for _, count in included)
+    corpus = FeatureStats.corpus(session)
+
+    if corpus is not None and len(excluded) < len(included) and \
+            total * 2 >= corpus.count:
+        stats = corpus.arrays
+        for start in range(0, len(excluded), 500):
+            for row in session.query(FeatureStats).filter(
+                    FeatureStats.mediafile_id.in_(
+                        excluded[start:start + 500])):
+                stats = subtract_stats(stats, row.arrays)
+    else:
+        rows = session.query(FeatureStats).filter(
+            FeatureStats.mediafile_id.in_(list(mediafiles))).all()
+        stats = rows[0].arrays
+        for row in rows[1:]:
+            if len(row.arrays[1]) != len(stats[1]):
+                return None
+            stats = combine_stats(stats, row.arrays)
+
+    count, mean, m2 = stats
+    return mean, numpy.sqrt(m2 / count)
+
+
+def feature_column(session, label, units, chunksize=500):
+    """Load the values of a single feature of many units.
+
+    Returns an array with the value of the feature for each unit, in the
+    order of units, NaN where a unit has no feature with that label. The
+    slot of the feature is found by the database for features stored in
+    columns, and once per schema for packed features.
+
+    Args:
+      session: Sqlalchemy database session
+      label (str): The label of the feature
+      units (list): IDs of the units
+
+    Kwargs:
+      chunksize (int): Number of units to query at once
+
+    """
+    units = [int(unit) for unit in units]
+    indexes = {unit: index for index, unit in enumerate(units)}
+    values = numpy.empty(len(units), dtype=DTYPE)
+    values.fill(numpy.nan)
+
+    value = case([(getattr(Features, "label_{}".format(slot)) == label,
+                   getattr(Features, "feat_{}".format(slot)))
+                  for slot in range(FEATURE_SLOTS)])
+
+    for start in range(0, len(units), chunksize):
+        chunk = units[start:start + chunksize]
+
+        columns = session.query(Features.unit_id, value).filter(
+            Features.unit_id.in_(chunk), Features.vector.is_(None))
+        for unit, feature in columns:
+            if feature is not None:
+                values[indexes[unit]] = feature
+
+        packed = collections.defaultdict(list)
+        for unit, schema, vector in session.query(
+                Features.unit_id, Features.schema_id, Features.vector).filter(
+                Features.unit_id.in_(chunk), Features.vector.isnot(None)):
+            packed[schema].append((unit, vector))
+
+        for schema, rows in packed.items():
+            slot = session.query(FeatureSchema).get(schema).slots.get(label)
+            if slot is None:
+                continue
+            matrix = numpy.frombuffer(
+                b"".join(vector for _, vector in rows), dtype=DTYPE)
+            matrix = matrix.reshape(len(rows), -1)
+            values[[indexes[unit] for unit, _ in rows]] = matrix[:, slot]
+
+    return values
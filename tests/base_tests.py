@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014, David Poulter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import unicode_literals
+import threading
+import time
+import unittest
+
+import numpy
+
+from consyn.base import AnalysisStage
+from consyn.base import AudioFrame
+from consyn.base import ChannelAnalyser
+from consyn.base import allocations
+from consyn.base import ParallelStage
+from consyn.base import Pipeline
+from consyn.base import PrefetchUnitLoader
+from consyn.base import ThreadedPipeline
+from consyn.base import UnitLoaderStage
+from consyn.models import Unit
+
+
+class AudioFrameTests(unittest.TestCase):
+
+    def test_positional(self):
+        frame = AudioFrame(None, 44100, 10, 1, 0, "test.wav", 20)
+        self.assertEqual(frame.samplerate, 44100)
+        self.assertEqual(frame.position, 10)
+        self.assertEqual(frame.channel, 1)
+        self.assertEqual(frame.path, "test.wav")
+        self.assertEqual(len(frame), 20)
+
+    def test_repr(self):
+        frame = AudioFrame(position=10, duration=20)
+        self.assertEqual(repr(frame), "<AudioFrame(position=10, duration=20)>")
+
+    def test_allocations(self):
+        count = allocations["frames"]
+        AudioFrame()
+        self.assertEqual(allocations["frames"], count + 1)
+
+    def test_allocations_threads(self):
+        count = allocations["frames"]
+        threads = [threading.Thread(target=lambda: [
+            AudioFrame() for _ in range(2000)]) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(allocations["frames"], count + 16000)
+
+    def test_copy(self):
+        frame = AudioFrame(numpy.zeros(4), 44100, 10, 1, 0, "test.wav", 4)
+        copy = frame.copy()
+        frame.samples[0] = 1
+        self.assertEqual(copy.samples[0], 0)
+        self.assertEqual(copy.position, 10)
+
+
+def _reuse_frame(count):
+    """Pass on the same frame, overwriting its samples in place."""
+    samples = numpy.zeros(4)
+    frame = AudioFrame(samples, 44100, 0, 0, 0, "test.wav", 4)
+    for value in range(count):
+        samples.fill(value)
+        frame.position = value
+        yield {"frame": frame}
+
+
+def _frame_values(pipe):
+    return [(pool["frame"].position, pool["frame"].samples[0])
+            for pool in pipe]
+
+
+class DummyUnitLoader(UnitLoaderStage):
+
+    def __init__(self, **kwargs):
+        super(DummyUnitLoader, self).__init__(**kwargs)
+        self.closed = False
+
+    def read(self, path, unit):
+        if unit.duration < 0:
+            raise ValueError("Negative duration")
+        # Later units are quicker to read, to test ordering
+        time.sleep(0.001 * (10 - unit.id))
+        frame = AudioFrame()
+        frame.samples = numpy.zeros(unit.duration)
+        frame.position = unit.position
+        frame.duration = unit.duration
+        frame.path = path
+        yield frame
+
+    def close(self):
+        self.closed = True
+
+
+class PrefetchUnitLoaderTests(unittest.TestCase):
+
+    def _units(self, durations):
+        return [{"unit": Unit(id=index, position=index * 10, duration=dur),
+                 "path": "test.wav"}
+                for index, dur in enumerate(durations)]
+
+    def test_order(self):
+        loader = DummyUnitLoader()
+        pipeline = Pipeline([
+            lambda _: iter(self._units([4] * 10)),
+            PrefetchUnitLoader(loader, depth=3, workers=3),
+            lambda pipe: [context["frame"].position for context in pipe]
+        ])
+
+        self.assertEqual(pipeline.run(), range(0, 100, 10))
+        self.assertTrue(loader.closed)
+
+    def test_errors_propagate(self):
+        pipeline = Pipeline([
+            lambda _: iter(self._units([4, 4, -1, 4])),
+            PrefetchUnitLoader(DummyUnitLoader(), depth=2),
+            list
+        ])
+
+        self.assertRaises(ValueError, pipeline.run)
+
+
+class ThreadedPipelineTests(unittest.TestCase):
+
+    def _double(self, pipe):
+        for pool in pipe:
+            pool["value"] *= 2
+            yield pool
+
+    def _reuse(self, count):
+        pool = {}
+        for value in range(count):
+            pool["value"] = value
+            yield pool
+
+    def test_order(self):
+        pipeline = ThreadedPipeline([
+            lambda _: self._reuse(100),
+            self._double,
+            self._double,
+            lambda pipe: [pool["value"] for pool in pipe]
+        ], maxsize=4)
+
+        self.assertEqual(pipeline.run(), [value * 4 for value in range(100)])
+        self.assertEqual(len(pipeline.queues), 3)
+
+    def test_groups(self):
+        stages = [self._double] * 5
+        pipeline = ThreadedPipeline(stages, boundaries=[2, 4, 7])
+        self.assertEqual([len(group) for group in pipeline.groups()],
+                         [2, 2, 1])
+
+    def test_errors_propagate(self):
+        def fail(pipe):
+            for pool in pipe:
+                if pool["value"] == 5:
+                    raise ValueError("Failed")
+                yield pool
+
+        pipeline = ThreadedPipeline([
+            lambda _: self._reuse(10),
+            fail,
+            self._double,
+            list
+        ])
+
+        self.assertRaises(ValueError, pipeline.run)
+
+    def test_backpressure(self):
+        produced = []
+
+        def produce(_):
+            for value in range(50):
+                produced.append(value)
+                yield {"value": value}
+
+        def consume(pipe):
+            values = []
+            for pool in pipe:
+                time.sleep(0.001)
+                values.append(len(produced) - pool["value"])
+            return values
+
+        pipeline = ThreadedPipeline([produce, consume], maxsize=3)
+        ahead = pipeline.run()
+        self.assertTrue(max(ahead) <= 3 + 2)
+        self.assertTrue(pipeline.peaks[0] <= 3)
+
+    def test_reused_frames(self):
+        pipeline = ThreadedPipeline([
+            lambda _: _reuse_frame(50),
+            _frame_values
+        ], maxsize=8)
+        self.assertEqual(pipeline.run(),
+                         [(value, value) for value in range(50)])
+
+
+def _square(pipe):
+    for pool in pipe:
+        if pool["value"] % 3 == 0:
+            continue
+        if pool["value"] < 0:
+            raise ValueError("Negative value")
+        pool["value"] = pool["value"] ** 2
+        yield pool
+
+
+class ParallelStageTests(unittest.TestCase):
+
+    def _run(self, values, **kwargs):
+        pipeline = Pipeline([
+            lambda _: ({"value": value} for value in values),
+            ParallelStage(_square, **kwargs),
+            lambda pipe: [pool["value"] for pool in pipe]
+        ])
+        return pipeline.run()
+
+    def _expected(self, values):
+        return [value ** 2 for value in values if value % 3 != 0]
+
+    def test_threads(self):
+        values = range(100)
+        self.assertEqual(self._run(values, workers=4, chunksize=3),
+                         self._expected(values))
+
+    def test_processes(self):
+        values = range(50)
+        self.assertEqual(self._run(values, workers=2, processes=True),
+                         self._expected(values))
+
+    def test_unordered(self):
+        values = range(100)
+        results = self._run(values, workers=4, chunksize=1, ordered=False)
+        self.assertEqual(sorted(results), self._expected(values))
+
+    def test_empty(self):
+        self.assertEqual(self._run([], workers=2), [])
+
+    def test_errors_propagate(self):
+        self.assertRaises(ValueError, self._run, [1, 2, -1, 4], workers=2)
+
+    def test_reused_frames(self):
+        pipeline = Pipeline([
+            lambda _: _reuse_frame(50),
+            ParallelStage(lambda pipe: pipe, workers=2, chunksize=4),
+            _frame_values
+        ])
+        self.assertEqual(pipeline.run(),
+                         [(value, value) for value in range(50)])
+
+
+class ChannelAnalyserTests(unittest.TestCase):
+
+    def test_analyser_per_channel(self):
+        class Counter(AnalysisStage):
+            def __init__(self):
+                self.count = 0
+
+            def analyse(self, frame):
+                self.count += 1
+                return {"count": self.count}
+
+        frames = [AudioFrame(numpy.zeros(4), 44100, index // 2,
+                             index % 2, index // 2, "", 4)
+                  for index in range(6)]
+        pipeline = Pipeline([
+            lambda _: ({"frame": frame} for frame in frames),
+            ChannelAnalyser(Counter),
+            list
+        ])
+        self.assertEqual([(pool["frame"].channel, pool["features"]["count"])
+                          for pool in pipeline.run()],
+                         [(0, 1), (1, 1), (0, 2), (1, 2), (0, 3), (1, 3)])
+
+    def test_len(self):
+        class Empty(AnalysisStage):
+            created = 0
+
+            def __init__(self):
+                Empty.created += 1
+
+            def analyse(self, frame):
+                return {}
+
+            def __len__(self):
+                return 0
+
+        analyser = ChannelAnalyser(Empty)
+        analyser.analyse(AudioFrame(numpy.zeros(4), 44100, 0, 0, 0, "", 4))
+        self.assertEqual(len(analyser), 0)
+        self.assertEqual(Empty.created, 1)
+
+
+class PipelineProfileTests(unittest.TestCase):
+
+    def _stages(self):
+        def produce(_):
+            for value in range(5):
+                time.sleep(0.01)
+                yield {"value": value}
+
+        def slow(pipe):
+            for pool in pipe:
+                time.sleep(0.02)
+                yield pool
+
+        def skip(pipe):
+            for pool in pipe:
+                if pool["value"] % 2 == 0:
+                    yield pool
+
+        return [produce, slow, skip, list]
+
+    def test_profile(self):
+        pipeline = Pipeline(self._stages(), profile=True)
+        self.assertEqual(len(pipeline.run()), 3)
+
+        produce, slow, skip, results = pipeline.profiles
+        self.assertEqual([profile.count for profile in pipeline.profiles],
+                         [5, 5, 3, 3])
+        self.assertTrue(0.04 <= produce.time < 0.09)
+        self.assertTrue(0.09 <= slow.time < 0.14)
+        self.assertTrue(slow.upstream >= 0.04)
+        self.assertTrue(skip.time < 0.02)
+        self.assertTrue(skip.throughput > slow.throughput)
+
+    def test_summary(self):
+        pipeline = ThreadedPipeline(self._stages(), boundaries=[2],
+                                    profile=True)
+        pipeline.run()
+        summary = pipeline.summary()
+        for name in ["produce", "slow", "skip", "list", "queue 0"]:
+            self.assertTrue(name in summary)
+
+    def test_disabled(self):
+        pipeline = Pipeline(self._stages())
+        pipeline.run()
+        self.assertEqual(pipeline.profiles, [])
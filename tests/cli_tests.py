@@ -15,11 +15,17 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import unicode_literals
 import os
+import shutil
+import tempfile
 import unittest
 
 from click.testing import CliRunner
 
+from consyn.cli import create_session
 from consyn.cli import main
+from consyn.cli.mosaic import partition
+from consyn.commands import add_mediafile
+from consyn.models import MediaFile
 
 from . import SOUND_DIR
 
@@ -52,3 +58,94 @@ class CLITests(unittest.TestCase):
             "--verbose", self.database, "rm", "1", "2"])
         self.assertEqual(result.exception, None)
         self.assertEqual(result.exit_code, 0)
+
+
+class CreateSessionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_sqlite_pragmas(self):
+        database = "sqlite:///{}".format(os.path.join(self.path, "test.db"))
+        session = create_session(database)
+
+        self.assertEqual(session.execute("PRAGMA journal_mode").scalar(),
+                         "wal")
+        self.assertEqual(session.execute("PRAGMA synchronous").scalar(), 1)
+        self.assertEqual(session.execute("PRAGMA temp_store").scalar(), 2)
+        self.assertEqual(session.execute("PRAGMA cache_size").scalar(),
+                         -65536)
+        session.close()
+
+
+class MosaicTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.database = "sqlite:///{}".format(
+            os.path.join(self.path, "test.db"))
+
+        session = create_session(self.database)
+        for name in ("amen-stereo.wav", "hot_tamales.wav", "rimbo.wav"):
+            add_mediafile(session, os.path.join(SOUND_DIR, name),
+                          segmentation="beats")
+        session.commit()
+        session.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _mosaic(self, name, *args):
+        output = os.path.join(self.path, name)
+        result = CliRunner().invoke(main, [
+            "--database", self.database, "mosaic", output, "1", "2", "3"] +
+            list(args))
+        self.assertEqual(result.exception, None)
+        with open(output, "rb") as fp:
+            return fp.read()
+
+    def test_partition(self):
+        session = create_session(self.database)
+        target = session.query(MediaFile).get(1)
+        ranges = partition(session, target, 3)
+        session.close()
+
+        self.assertEqual(len(ranges), 3)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], target.duration)
+        for (_, end), (start, _) in zip(ranges[:-1], ranges[1:]):
+            self.assertEqual(end, start)
+
+    def test_jobs(self):
+        single = self._mosaic("single.wav")
+        self.assertEqual(self._mosaic("jobs.wav", "--jobs", "2"), single)
+        self.assertEqual(
+            self._mosaic("threaded.wav", "--jobs", "2", "--threaded"), single)
+
+    def test_jobs_concatenate(self):
+        result = CliRunner().invoke(main, [
+            "--database", self.database, "mosaic",
+            os.path.join(self.path, "clip.wav"), "1", "2", "3",
+            "--jobs", "2", "--concatenate", "clip"])
+        self.assertEqual(result.exit_code, 2)
+        self.assertFalse(os.path.exists(os.path.join(self.path, "clip.wav")))
+
+    def test_memmap_stream(self):
+        result = CliRunner().invoke(main, [
+            "--database", self.database, "mosaic",
+            os.path.join(self.path, "out.wav"), "1", "2", "3",
+            "--memmap", "--concatenate", "stream"])
+        self.assertEqual(result.exit_code, 2)
+        self.assertFalse(os.path.exists(os.path.join(self.path, "out.wav")))
+
+    def test_matrix_options(self):
+        for option in (["--snapshot", self.path], ["--normalize"]):
+            result = CliRunner().invoke(main, [
+                "--database", self.database, "mosaic",
+                os.path.join(self.path, "out.wav"), "1", "2", "3"] + option)
+            self.assertEqual(result.exit_code, 2)
+            self.assertFalse(
+                os.path.exists(os.path.join(self.path, "out.wav")))
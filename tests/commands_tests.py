@@ -16,12 +16,19 @@
 from __future__ import unicode_literals
 import os
 
+import numpy
+
 from consyn.commands import add_mediafile
 from consyn.commands import cluster_units
+from consyn.commands import fit_projection
 from consyn.commands import get_mediafile
 from consyn.commands import remove_mediafile
+from consyn.commands import remove_mediafiles
+from consyn.models import FeatureStats
 from consyn.models import Features
 from consyn.models import MediaFile
+from consyn.models import Projection
+from consyn.models import Unit
 
 from . import SOUND_DIR
 from . import DatabaseTests
@@ -51,6 +58,25 @@ class AddMediaFileTests(DatabaseTests):
     def test_mono_mediafile(self):
         self._test_file("amen-mono.wav", 13, 44100, 1, 70560)
 
+    def test_parallel_channels(self):
+        path = os.path.join(SOUND_DIR, "amen-stereo.wav")
+        results = []
+
+        for jobs in (1, 2):
+            mediafile = add_mediafile(self.session, path,
+                                      segmentation="beats", jobs=jobs)
+            self.session.flush()
+            results.append((
+                mediafile.channels,
+                mediafile.duration,
+                mediafile.features.count(),
+                [(unit.channel, unit.position, unit.duration)
+                 for unit in mediafile.units],
+                [list(unit.features.array) for unit in mediafile.units]))
+            self.session.rollback()
+
+        self.assertEqual(results[0], results[1])
+
 
 class GetMediaFileTests(DatabaseTests):
 
@@ -76,6 +102,40 @@ class RemoveMediaFileTests(DatabaseTests):
         self.assertEqual(self.session.query(MediaFile).count(), 0)
 
 
+class RemoveMediaFilesTests(DatabaseTests):
+
+    def setUp(self):
+        super(RemoveMediaFilesTests, self).setUp()
+        self.mediafiles = [
+            add_mediafile(self.session, os.path.join(SOUND_DIR, name),
+                          segmentation="beats")
+            for name in ("amen-mono.wav", "hot_tamales.wav")]
+        self.session.commit()
+
+    def test_some(self):
+        keep, remove = self.mediafiles
+        keep_units = keep.units.count()
+        count = remove_mediafiles(self.session, [remove.id, "missing.wav"])
+
+        self.assertEqual(count, 1)
+        self.assertEqual(self.session.query(MediaFile).all(), [keep])
+        self.assertEqual(self.session.query(Unit).count(), keep_units)
+        self.assertEqual(self.session.query(Features).count(), keep_units)
+        self.assertEqual(self.session.query(FeatureStats).filter(
+            FeatureStats.mediafile_id.isnot(None)).one().mediafile, keep)
+
+        corpus = FeatureStats.corpus(self.session)
+        self.assertEqual(corpus.count, keep_units)
+        for expected, array in zip(keep.stats.arrays[1:],
+                                   corpus.arrays[1:]):
+            self.assertTrue(numpy.allclose(array, expected))
+
+    def test_all(self):
+        self.assertEqual(remove_mediafiles(self.session), 2)
+        for model in (MediaFile, Unit, Features, FeatureStats):
+            self.assertEqual(self.session.query(model).count(), 0)
+
+
 class ClusterUnitsTests(DatabaseTests):
 
     def test_simple(self):
@@ -92,3 +152,65 @@ class ClusterUnitsTests(DatabaseTests):
             unique.add(cluster[0])
 
         self.assertEqual(len(unique), 3)
+
+    def test_packed(self):
+        add_mediafile(self.session, os.path.join(SOUND_DIR, "amen-mono.wav"),
+                      segmentation="beats", storage="packed")
+        cluster_units(self.session, 3)
+
+        clusters = self.session.query(Features.cluster).distinct().all()
+        self.assertEqual(len(clusters), 3)
+
+    def test_mixed(self):
+        for name, storage in (("amen-mono.wav", "columns"),
+                              ("amen-stereo.wav", "packed")):
+            add_mediafile(self.session, os.path.join(SOUND_DIR, name),
+                          segmentation="beats", storage=storage)
+        cluster_units(self.session, 3)
+        fit_projection(self.session, dims=4)
+
+        clusters = self.session.query(Features.cluster).distinct().all()
+        self.assertEqual(len(clusters), 3)
+
+    def test_projection(self):
+        add_mediafile(self.session, os.path.join(SOUND_DIR, "amen-mono.wav"),
+                      segmentation="beats", storage="packed")
+        fit_projection(self.session, dims=4)
+        cluster_units(self.session, 3, projection="default")
+
+        clusters = self.session.query(Features.cluster).distinct().all()
+        self.assertEqual(len(clusters), 3)
+
+        with self.assertRaises(ValueError):
+            cluster_units(self.session, 3, projection="missing")
+
+
+class FitProjectionTests(DatabaseTests):
+
+    def test_simple(self):
+        path = os.path.join(SOUND_DIR, "hot_tamales.wav")
+        add_mediafile(self.session, path, segmentation="beats")
+        projection = fit_projection(self.session, dims=4)
+        self.session.flush()
+
+        features = self.session.query(Features).first().array
+        self.assertEqual(projection.dims, 4)
+        self.assertEqual(projection.features, features.shape[0])
+        self.assertEqual(projection.transform(features).shape, (4,))
+
+        # Components are orthonormal
+        _, _, components = projection.arrays
+        self.assertTrue(numpy.allclose(
+            components.dot(components.T), numpy.eye(4), atol=1e-4))
+
+    def test_replace(self):
+        path = os.path.join(SOUND_DIR, "amen-mono.wav")
+        add_mediafile(self.session, path, segmentation="beats")
+        fit_projection(self.session, dims=4)
+        fit_projection(self.session, dims=2)
+        self.session.flush()
+        self.assertEqual(self.session.query(Projection).one().dims, 2)
+
+    def test_empty(self):
+        with self.assertRaises(ValueError):
+            fit_projection(self.session)
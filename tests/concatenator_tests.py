@@ -15,6 +15,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import unicode_literals
 import os
+import unittest
 
 import numpy
 
@@ -23,6 +24,7 @@ from consyn.base import Pipeline
 from consyn.commands import add_mediafile
 from consyn.concatenators import BaseConcatenator
 from consyn.concatenators import concatenator
+from consyn.concatenators import settings
 from consyn.ext import UnitLoader
 from consyn.models import MediaFile
 from consyn.models import Unit
@@ -68,6 +70,60 @@ class ConcatenateTests(DatabaseTests):
         self.assertEqual(concatenate.buffer.shape, (2, 50))
         self.assertEqual(list(concatenate.buffer[0][25:35]), [3] * 10)
 
+    def test_memmap_buffer(self):
+        mediafile = MediaFile(duration=50, channels=2, path="test.wav")
+        concatenate = concatenator("overlay", mediafile, memmap=True)
+        self.assertTrue(isinstance(concatenate.buffer, numpy.memmap))
+
+        results = list(concatenate([
+            {"frame": AudioFrame(samples=numpy.array([3] * 10)),
+             "unit": Unit(channel=1, position=25, duration=10)}
+        ]))
+
+        self.assertEqual(results[0]["buffer"].shape, (2, 50))
+        self.assertEqual(list(results[0]["buffer"][1][20:40]),
+                         [0] * 5 + [3] * 10 + [0] * 5)
+
+    def test_memmap_dir(self):
+        mediafile = MediaFile(duration=50, channels=2, path="test.wav")
+        directory = settings.get("memmap_dir")
+        settings["memmap_dir"] = "/nonexistent/consyn"
+        try:
+            with self.assertRaises(OSError):
+                concatenator("overlay", mediafile, memmap=True)
+        finally:
+            settings["memmap_dir"] = directory
+
+    def test_overlay_overrun(self):
+        """Test units running past the end of the target are kept"""
+        mediafile = MediaFile(duration=50, channels=2, path="test.wav")
+        concatenate = concatenator("overlay", mediafile)
+
+        results = list(concatenate([
+            {"frame": AudioFrame(samples=numpy.array([1] * 20)),
+             "unit": Unit(channel=0, position=40, duration=10)},
+            {"frame": AudioFrame(samples=numpy.array([2] * 30)),
+             "unit": Unit(channel=1, position=45, duration=10)},
+            {"frame": AudioFrame(samples=numpy.array([3] * 10)),
+             "unit": Unit(channel=0, position=0, duration=10)}
+        ]))
+
+        buff = results[0]["buffer"]
+        self.assertEqual(buff.shape, (2, 75))
+        self.assertEqual(list(buff[0][:10]), [3] * 10)
+        self.assertEqual(list(buff[0][40:]), [1] * 20 + [0] * 15)
+        self.assertEqual(list(buff[1][45:]), [2] * 30)
+
+    def test_overlay_headroom(self):
+        mediafile = MediaFile(duration=50, channels=1, path="test.wav")
+        concatenate = concatenator("overlay", mediafile, headroom=10)
+        results = list(concatenate([
+            {"frame": AudioFrame(samples=numpy.array([1] * 5)),
+             "unit": Unit(channel=0, position=48, duration=2)}
+        ]))
+        self.assertEqual(concatenate.buffer.shape, (1, 60))
+        self.assertEqual(results[0]["buffer"].shape, (1, 53))
+
     def _test_clipper(self, samples, target):
         mediafile = MediaFile(duration=target.duration, channels=2,
                               path="test.wav")
@@ -94,3 +150,55 @@ class ConcatenateTests(DatabaseTests):
         target = Unit(duration=20)
         result = self._test_clipper(numpy.arange(20), target)
         self.assertEqual(list(samples), list(result))
+
+
+class StreamingConcatenatorTests(unittest.TestCase):
+
+    def _pools(self):
+        units = [(0, 0, 30), (1, 0, 20), (0, 20, 30), (1, 25, 10),
+                 (0, 90, 30)]
+        return [{"frame": AudioFrame(samples=numpy.arange(
+                    duration, dtype="float32") + index),
+                 "unit": Unit(channel=channel, position=position,
+                              duration=duration)}
+                for index, (channel, position, duration) in enumerate(units)]
+
+    def test_same_as_overlay(self):
+        mediafile = MediaFile(duration=100, channels=2, path="test.wav")
+        overlay = concatenator("overlay", mediafile)
+        expected = list(overlay(self._pools()))[0]["buffer"]
+
+        stream = concatenator("stream", mediafile)
+        results = list(stream(self._pools()))
+
+        self.assertEqual([result["position"] for result in results],
+                         [0, 20, 25, 90])
+        buff = numpy.concatenate(
+            [result["buffer"] for result in results], axis=1)
+        self.assertEqual(buff.shape, (2, 120))
+        self.assertEqual(buff.tolist(), expected.tolist())
+        self.assertTrue(stream.buffer.shape[1] <= 60)
+
+    def test_partitions(self):
+        mediafile = MediaFile(duration=100, channels=2, path="test.wav")
+        overlay = concatenator("overlay", mediafile)
+        expected = list(overlay(self._pools()))[0]["buffer"]
+
+        pools = self._pools()
+        mosaic = concatenator("overlay", mediafile)
+        for start, end in [(0, 25), (25, 100)]:
+            stream = concatenator("stream", mediafile, start=start, end=end)
+            results = list(stream([pool for pool in pools
+                                   if start <= pool["unit"].position < end]))
+            self.assertEqual(results[0]["position"], start)
+            mosaic.overlay(start, numpy.concatenate(
+                [result["buffer"] for result in results], axis=1))
+
+        self.assertEqual(mosaic.get_buffer().tolist(), expected.tolist())
+
+    def test_unordered(self):
+        mediafile = MediaFile(duration=100, channels=2, path="test.wav")
+        stream = concatenator("stream", mediafile)
+        pools = self._pools()
+        pools.reverse()
+        self.assertRaises(ValueError, list, stream(pools))
@@ -19,6 +19,7 @@ import os
 import numpy
 
 from consyn.base import Pipeline
+from consyn.base import allocations
 from consyn.models import Unit
 
 from .. import SOUND_DIR
@@ -69,6 +70,52 @@ class FileLoaderTests(object):
         channels = set([res["frame"].channel for res in results])
         self.assertEqual(channels, set([0, 1]))
 
+    def test_select_channels(self):
+        """Test frames are only generated for the selected channels"""
+        path = os.path.join(SOUND_DIR, "amen-stereo.wav")
+
+        every = Pipeline([self.FileLoader(path, hopsize=1024)]).run()
+        selected = Pipeline([
+            self.FileLoader(path, hopsize=1024, channels=[1])]).run()
+
+        every = [res["frame"] for res in every if res["frame"].channel == 1]
+        selected = [res["frame"] for res in selected]
+        self.assertEqual(len(selected), len(every))
+        for expected, frame in zip(every, selected):
+            self.assertEqual(frame.channel, 1)
+            self.assertEqual(frame.position, expected.position)
+            self.assertTrue(numpy.array_equal(frame.samples,
+                                              expected.samples))
+
+    def test_reuse_frames(self):
+        """Test one frame is reused per channel"""
+        path = os.path.join(SOUND_DIR, "amen-stereo.wav")
+        loader = self.FileLoader(path, hopsize=1024, reuse_frames=True)
+
+        frames = {}
+        positions = {0: 0, 1: 0}
+        for res in loader():
+            frame = res["frame"]
+            self.assertTrue(frames.setdefault(frame.channel, frame) is frame)
+            self.assertEqual(frame.position, positions[frame.channel])
+            positions[frame.channel] += frame.duration
+
+        self.assertEqual(len(frames), 2)
+
+    def test_reuse_frames_allocations(self):
+        """Test reusing frames allocates fewer of them"""
+        path = os.path.join(SOUND_DIR, "amen-stereo.wav")
+
+        counts = []
+        for reuse_frames in (False, True):
+            count = allocations["frames"]
+            loader = self.FileLoader(path, hopsize=1024,
+                                     reuse_frames=reuse_frames)
+            hops = len(list(loader()))
+            counts.append(allocations["frames"] - count)
+
+        self.assertEqual(counts, [hops, 2])
+
 
 class UnitLoaderTests(object):
 
@@ -96,6 +143,15 @@ class UnitLoaderTests(object):
         self.assertEqual(samples.shape, (70560,))
         self.assertNotEqual(numpy.sum(samples), 0)
 
+    def test_decode_allocations(self):
+        path = os.path.join(SOUND_DIR, "amen-stereo.wav")
+        unit = Unit(channel=0, position=4410, duration=4410)
+
+        count = allocations["buffers"]
+        Pipeline([self.UnitLoader(hopsize=1024), list]).run(
+            {"path": path, "unit": unit})
+        self.assertTrue(allocations["buffers"] > count)
+
     def test_multiple_reads(self):
         reads = 10
         bufsize = 1024
@@ -119,3 +175,19 @@ class UnitLoaderTests(object):
             self.assertNotEqual(numpy.sum(samples), 0)
 
         self.assertEqual(index, reads - 1)
+
+    def test_sibling_units(self):
+        """Test sibling units read the same samples as separate reads"""
+        path = os.path.join(SOUND_DIR, "amen-stereo.wav")
+        left = Unit(channel=0, position=4410, duration=2048)
+        right = Unit(channel=1, position=4410, duration=2048)
+
+        loader = self.UnitLoader(hopsize=1024)
+        result = Pipeline([loader, list]).run(
+            {"path": path, "unit": left}, {"path": path, "unit": right})
+        self.assertEqual(len(result), 2)
+
+        expected = Pipeline([self.UnitLoader(hopsize=1024), list]).run(
+            {"path": path, "unit": right})
+        self.assertEqual(list(result[1]["frame"].samples),
+                         list(expected[0]["frame"].samples))
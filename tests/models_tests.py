@@ -16,11 +16,17 @@
 from __future__ import unicode_literals
 import unittest
 
+import numpy
+
+from consyn.models import FeatureSchema
 from consyn.models import Features
 from consyn.models import MediaFile
 from consyn.models import Unit
+from consyn.models import migrate
 from consyn import settings
 
+from . import DatabaseTests
+
 
 class MediaFileTests(unittest.TestCase):
 
@@ -37,6 +43,20 @@ class MediaFileTests(unittest.TestCase):
         self.assertEqual(str(mediafile), "<MediaFile({})>".format(r))
 
 
+class MediaFileReprTests(DatabaseTests):
+
+    def test_persistent(self):
+        mediafile = MediaFile(path="/test/case.mp3", duration=10,
+                              channels=1, samplerate=80)
+        for position in range(3):
+            Unit(mediafile=mediafile, channel=0, position=position,
+                 duration=1)
+        self.session.add(mediafile)
+        self.session.commit()
+
+        self.assertTrue(repr(mediafile).endswith(", units=3)>"))
+
+
 class UnitTests(unittest.TestCase):
 
     def test_repr(self):
@@ -77,3 +97,105 @@ class FeaturesTests(unittest.TestCase):
     def test_get_feature_exception(self):
         features = Features({"feat_1": 0.1})
         self.assertRaises(Exception, features.__getitem__, "feat_2")
+
+    def test_packed(self):
+        schema = FeatureSchema(names="feat_3\nfeat_1")
+        features = Features({"feat_1": 0.1, "feat_3": 0.3}, schema=schema)
+
+        self.assertTrue(features.packed)
+        self.assertEqual(len(features.vector), 8)
+        self.assertEqual(features.array.tolist(),
+                         [numpy.float32(0.3), numpy.float32(0.1)])
+        self.assertAlmostEqual(features["feat_1"], 0.1)
+        self.assertEqual([label for _, label, _ in features],
+                         ["feat_3", "feat_1"])
+        self.assertRaises(Exception, features.__getitem__, "feat_2")
+
+    def test_slots_shared(self):
+        first = Features({"feat_1": 0.1, "feat_2": 0.2})
+        second = Features({"feat_1": 0.3, "feat_2": 0.4})
+        self.assertTrue(first.slots is second.slots)
+        self.assertEqual(second["feat_2"], 0.4)
+
+        schema = FeatureSchema(names="feat_1\nfeat_2")
+        packed = Features({"feat_1": 0.1, "feat_2": 0.2}, schema=schema)
+        self.assertEqual(packed.slots, {"feat_1": 0, "feat_2": 1})
+
+    def test_columns_array(self):
+        features = Features({"feat_1": 0.5})
+        array = features.array
+        self.assertFalse(features.packed)
+        self.assertEqual(array.shape, (settings.FEATURE_SLOTS,))
+        self.assertEqual(array[0], 0.5)
+
+
+class FeatureSchemaTests(DatabaseTests):
+
+    def test_get_or_create(self):
+        schema = FeatureSchema.get_or_create(self.session, ["a", "b"])
+        self.assertEqual(schema.labels, ["a", "b"])
+        self.session.flush()
+
+        self.assertEqual(
+            FeatureSchema.get_or_create(self.session, ["a", "b"]).id,
+            schema.id)
+        self.assertNotEqual(
+            FeatureSchema.get_or_create(self.session, ["b", "a"]), schema)
+
+    def test_packed_columns_null(self):
+        schema = FeatureSchema.get_or_create(self.session, ["a", "b"])
+        self.session.add(Features({"a": 0.1, "b": 0.2}, schema=schema))
+        self.session.add(Features({"a": 0.1, "b": 0.2}))
+        self.session.commit()
+
+        packed, columns = self.session.query(Features).order_by(Features.id)
+        for index in range(settings.FEATURE_SLOTS):
+            name = "feat_{}".format(index)
+            self.assertIsNone(getattr(packed, name))
+            self.assertIsNotNone(getattr(columns, name))
+
+
+class IndexTests(DatabaseTests):
+
+    def _plan(self, query):
+        dialect = self.session.bind.dialect
+        compiled = query.statement.compile(dialect=dialect)
+        params = tuple(compiled.params[name] for name in compiled.positiontup)
+        rows = self.session.connection().execute(
+            "EXPLAIN QUERY PLAN {}".format(compiled), params)
+        return " ".join(row["detail"] for row in rows)
+
+    def test_units_by_mediafile(self):
+        mediafile = MediaFile(path="/test/case.mp3", duration=10, channels=1,
+                              samplerate=80)
+        self.session.add(mediafile)
+        self.session.flush()
+
+        plan = self._plan(mediafile.units.filter(Unit.channel == 0)
+                          .order_by(Unit.position))
+        self.assertTrue("ix_units_mediafile_channel_position" in plan)
+        self.assertFalse("TEMP B-TREE" in plan)
+
+        plan = self._plan(self.session.query(Unit.id).filter(
+            Unit.mediafile_id.in_([1, 2])))
+        self.assertTrue("ix_units_mediafile_channel_position" in plan)
+
+    def test_features_by_mediafile(self):
+        plan = self._plan(self.session.query(Features.unit_id).filter(
+            Features.mediafile_id.in_([1, 2])))
+        self.assertTrue("ix_features_mediafile_id" in plan)
+
+    def test_features_by_unit(self):
+        plan = self._plan(self.session.query(Features).filter(
+            Features.unit_id == 1))
+        self.assertTrue("ix_features_unit_id" in plan)
+
+    def test_migrate(self):
+        engine = self.session.bind
+        engine.execute("DROP INDEX ix_features_unit_id")
+        engine.execute("DROP INDEX ix_units_mediafile_channel_position")
+
+        migrate(engine)
+        plan = self._plan(self.session.query(Features).filter(
+            Features.unit_id == 1))
+        self.assertTrue("ix_features_unit_id" in plan)
@@ -18,10 +18,49 @@ import unittest
 
 import numpy
 
+from consyn.base import AudioFrame
+from consyn.base import allocations
 from consyn.models import Unit
+from consyn.resynthesis import Chain
 from consyn.resynthesis import Envelope
+from consyn.resynthesis import Gain
+from consyn.resynthesis import SoftClipper
 from consyn.resynthesis import TimeStretch
 from consyn.resynthesis import TrimSilence
+from consyn.resynthesis import Workspace
+
+
+class ChainTests(unittest.TestCase):
+
+    def _run(self, stages, samples):
+        frame = AudioFrame(samples)
+        unit = Unit(duration=samples.shape[0])
+        return list(stages([{"frame": frame, "unit": unit, "target": unit}]))
+
+    def test_same_as_stages(self):
+        samples = numpy.array([0, 0, 1, 2, 3, 2, 1, 0], dtype="float32")
+        stages = [TrimSilence(cutoff=0.5), Gain(gain=2.0), Envelope(fade=2),
+                  SoftClipper()]
+
+        expected = samples.copy()
+        for stage in stages:
+            expected, _ = stage.process(expected, None, None)
+
+        results = self._run(Chain(stages), samples)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(list(results[0]["frame"].samples), list(expected))
+        self.assertEqual(results[0]["frame"].duration, expected.shape[0])
+
+    def test_in_place(self):
+        samples = numpy.array([1, 2, 3, 4], dtype="float32")
+        results = self._run(Chain([Gain(gain=0.5), SoftClipper()]), samples)
+        self.assertTrue(results[0]["frame"].samples is samples)
+
+    def test_empty(self):
+        samples = numpy.array([0, 0, 0], dtype="float32")
+        results = self._run(Chain([TrimSilence(cutoff=0.5), Gain()]),
+                            samples)
+        self.assertEqual(results, [])
 
 
 class EnvelopeTests(unittest.TestCase):
@@ -33,9 +72,86 @@ class EnvelopeTests(unittest.TestCase):
         self.assertEqual(list(samples), [
             0.0, 0.5, 1.0, 1.0, 1.0, 1.0, 1.0, 0.5, 0.0])
 
+    def test_shorter_than_fade(self):
+        envelope = Envelope(fade=30)
+        samples = numpy.array([1, 1, 1, 1, 1], dtype="float32")
+        samples, _ = envelope.process(samples, None, None)
+        self.assertEqual(list(samples), [0.0, 1.0, 1.0, 1.0, 0.0])
+
+        samples = numpy.array([1], dtype="float32")
+        samples, _ = envelope.process(samples, None, None)
+        self.assertEqual(list(samples), [1.0])
+
+
+class WorkspaceTests(unittest.TestCase):
+
+    def test_cached(self):
+        workspace = Workspace()
+        self.assertTrue(workspace.window(64) is workspace.window(64))
+        self.assertTrue(workspace.ramp(8) is workspace.ramp(8))
+        self.assertEqual(list(workspace.ramp(3, rising=False)), [1, 0.5, 0])
+
+    def test_scratch(self):
+        workspace = Workspace()
+        buff = workspace.scratch("test", (2, 8))
+        buff.fill(1)
+        again = workspace.scratch("test", (4, 2))
+        self.assertEqual(again.shape, (4, 2))
+        self.assertEqual(again.sum(), 0)
+        self.assertTrue(numpy.may_share_memory(buff, again))
+
+
+def _phase_vocoder(samples, factor, winsize=1024, overlap=4):
+    """The phase vocoder TimeStretch implemented before it was vectorised,
+    a frame at a time."""
+    hopsize = int(float(winsize) / float(overlap))
+    duration = len(samples)
+
+    phi = numpy.zeros(winsize)
+    out = numpy.zeros(winsize, dtype=complex)
+    sigout = numpy.zeros(int(float(duration) / float(factor) + winsize))
+    window = numpy.hanning(winsize)
+
+    amp = max(samples)
+    pos1 = 0
+    pos2 = 0
+
+    while pos2 < duration - (winsize + hopsize):
+        position = int(pos2)
+        spec1 = numpy.fft.fft(window * samples[position:position + winsize])
+        spec2 = numpy.fft.fft(window * samples[
+            position + hopsize:position + winsize + hopsize])
+        phi += (numpy.angle(spec2) - numpy.angle(spec1))
+        out.real = numpy.cos(phi)
+        out.imag = numpy.sin(phi)
+        sigout[pos1:pos1 + winsize] += (
+            window * numpy.fft.ifft(abs(spec2) * out)).real
+        pos1 += hopsize
+        pos2 += hopsize * factor
+
+    max_samp = max(sigout)
+    if max_samp != 0:
+        return numpy.array(amp * sigout / max_samp, dtype="float32")
+    return numpy.array(amp * sigout, dtype="float32")
+
 
 class TimestretchTests(unittest.TestCase):
 
+    def test_same_as_frame_loop(self):
+        """Test frames start where a running position puts them"""
+        state = numpy.random.RandomState(0)
+        samples = numpy.sin(numpy.arange(16384) * 0.03) * 3
+        samples += state.uniform(-1, 1, samples.shape[0])
+        samples = samples.astype("float32")
+
+        for factor in (0.37, 0.5, 1.3, 2.0):
+            expected = _phase_vocoder(samples, factor)
+            stretched, _ = TimeStretch(factor=factor).process(
+                samples, None, None)
+            self.assertEqual(stretched.shape, expected.shape)
+            self.assertTrue(numpy.allclose(stretched, expected, rtol=0,
+                                           atol=1e-5))
+
     def test_equal_duration(self):
         timestretch = TimeStretch()
         target = Unit(duration=5)
@@ -61,6 +177,34 @@ class TimestretchTests(unittest.TestCase):
         samples2, _ = timestretch.process(samples, None, target)
         self.assertEqual(samples2.shape[0], 5120)
 
+    def test_stretch_keeps_amplitude(self):
+        timestretch = TimeStretch()
+        samples = numpy.sin(numpy.arange(8192) * 0.05).astype("float32")
+        samples *= 0.5
+
+        samples2, _ = timestretch.process(
+            samples, Unit(duration=12288), Unit(duration=6144))
+        self.assertEqual(samples2.dtype, numpy.float32)
+        self.assertEqual(samples2.shape[0], 8192 * 2 + 1024)
+        self.assertAlmostEqual(samples2.max(), samples.max(), places=5)
+
+    def test_reuses_workspace(self):
+        timestretch = TimeStretch(factor=0.7)
+        samples = numpy.sin(numpy.arange(8192) * 0.05).astype("float32")
+        timestretch.process(samples, None, None)
+
+        # Only the output is allocated once the workspace has its buffers
+        count = allocations["buffers"]
+        timestretch.process(samples, None, None)
+        self.assertEqual(allocations["buffers"], count + 1)
+
+    def test_shorter_than_window(self):
+        timestretch = TimeStretch(factor=0.5)
+        samples = numpy.ones(100, dtype="float32")
+        samples2, _ = timestretch.process(samples, None, None)
+        self.assertEqual(samples2.shape[0], 1224)
+        self.assertEqual(samples2.max(), 0)
+
 
 class TrimSilenceTests(unittest.TestCase):
 
@@ -91,3 +235,30 @@ class TrimSilenceTests(unittest.TestCase):
         samples = numpy.array([1, 10, 10, -1, 2, 10], dtype="float32")
         samples, _ = trimmer.process(samples, None, None)
         self.assertEqual(map(int, list(samples)), [10, 10, -1, 2, 10])
+
+    def test_returns_view(self):
+        trimmer = TrimSilence(cutoff=0.5)
+        samples = numpy.array([0, 1, 1, 0], dtype="float32")
+        trimmed, _ = trimmer.process(samples, None, None)
+        self.assertEqual(list(trimmed), [1.0, 1.0])
+        self.assertTrue(numpy.may_share_memory(trimmed, samples))
+
+    def test_only_front(self):
+        trimmer = TrimSilence(cutoff=0.5, trim="f")
+        samples = numpy.array([0, 0, 1, 0], dtype="float32")
+        samples, _ = trimmer.process(samples, None, None)
+        self.assertEqual(list(samples), [1.0, 0.0])
+
+    def test_silent(self):
+        trimmer = TrimSilence(cutoff=0.5)
+        samples = numpy.array([0, 0.1, 0], dtype="float32")
+        samples, _ = trimmer.process(samples, None, None)
+        self.assertEqual(samples.shape[0], 0)
+
+    def test_window(self):
+        """Test trimming on the RMS level of windows"""
+        trimmer = TrimSilence(cutoff=0.5, window=2)
+        samples = numpy.array([0, 0, 0, 1, 1, 1, 0.1, 0, 0],
+                              dtype="float32")
+        samples, _ = trimmer.process(samples, None, None)
+        self.assertEqual(list(samples), [0.0, 1.0, 1.0, 1.0])
@@ -16,8 +16,15 @@
 from __future__ import unicode_literals
 import os
 
+import numpy
+
+from consyn.selections import MatrixNearestNeighbour
 from consyn.selections import NearestNeighbour
+from consyn.selections import RandomUnit
+from consyn.base import Pipeline
 from consyn.commands import add_mediafile
+from consyn.commands import fit_projection
+from consyn.utils import UnitGenerator
 
 from . import SOUND_DIR
 from . import DatabaseTests
@@ -34,3 +41,147 @@ class NearestNeighbourTests(DatabaseTests):
         for unit in mediafile.units:
             match = selector.select(unit)
             self.assertEqual(match.id, unit.id)
+
+    def test_packed(self):
+        path = os.path.join(SOUND_DIR, "amen-mono.wav")
+        mediafile = add_mediafile(self.session, path, segmentation="beats",
+                                  storage="packed")
+        self.session.flush()
+
+        selector = NearestNeighbour(self.session, [mediafile])
+        for unit in mediafile.units:
+            match = selector.select(unit)
+            self.assertEqual(match.id, unit.id)
+
+    def test_packed_target(self):
+        path = os.path.join(SOUND_DIR, "amen-mono.wav")
+        corpus = add_mediafile(self.session, path, segmentation="beats")
+        path = os.path.join(SOUND_DIR, "amen-stereo.wav")
+        target = add_mediafile(self.session, path, segmentation="beats",
+                               storage="packed")
+        self.session.flush()
+
+        selector = NearestNeighbour(self.session, [corpus])
+        matrix = MatrixNearestNeighbour(self.session, [corpus])
+        for unit in target.units:
+            match = selector.select(unit)
+            self.assertEqual(match.mediafile, corpus)
+            self.assertEqual(match.id, matrix.select(unit).id)
+
+
+class MatrixNearestNeighbourTests(DatabaseTests):
+
+    def _test_storage(self, storage):
+        path = os.path.join(SOUND_DIR, "amen-mono.wav")
+        mediafile = add_mediafile(self.session, path, segmentation="beats",
+                                  storage=storage)
+        self.session.flush()
+
+        selector = MatrixNearestNeighbour(self.session, [mediafile])
+        self.assertEqual(selector.matrix.shape[0], mediafile.units.count())
+        for unit in mediafile.units:
+            match = selector.select(unit)
+            self.assertEqual(match.id, unit.id)
+
+    def test_columns(self):
+        self._test_storage("columns")
+
+    def test_packed(self):
+        self._test_storage("packed")
+
+    def test_same_as_nearest(self):
+        target = add_mediafile(
+            self.session, os.path.join(SOUND_DIR, "amen-mono.wav"),
+            segmentation="beats")
+        corpus = add_mediafile(
+            self.session, os.path.join(SOUND_DIR, "hot_tamales.wav"),
+            segmentation="beats")
+        self.session.flush()
+
+        nearest = NearestNeighbour(self.session, [corpus])
+        matrix = MatrixNearestNeighbour(self.session, [corpus])
+        for unit in target.units:
+            self.assertEqual(matrix.select(unit).id, nearest.select(unit).id)
+
+    def test_normalize(self):
+        path = os.path.join(SOUND_DIR, "hot_tamales.wav")
+        mediafile = add_mediafile(self.session, path, segmentation="beats",
+                                  storage="packed")
+        self.session.flush()
+
+        plain = MatrixNearestNeighbour(self.session, [mediafile])
+        selector = MatrixNearestNeighbour(self.session, [mediafile],
+                                          normalize=True)
+        std = plain.matrix.std(axis=0)
+        self.assertTrue(numpy.allclose(
+            selector.scale * numpy.where(std > 0, std, 1), 1, rtol=1e-3))
+        for unit in mediafile.units:
+            # Silent units on either channel have the same features
+            self.assertTrue(numpy.array_equal(
+                selector.select(unit).features.array, unit.features.array))
+
+    def test_weights(self):
+        path = os.path.join(SOUND_DIR, "amen-mono.wav")
+        mediafile = add_mediafile(self.session, path, segmentation="beats")
+        self.session.flush()
+
+        label = list(mediafile.units.first().features)[1][1]
+        selector = MatrixNearestNeighbour(self.session, [mediafile],
+                                          weights={label: 3})
+        self.assertEqual(selector.scale[1], 3)
+        self.assertEqual(selector.scale.sum(), selector.scale.shape[0] + 2)
+
+        with self.assertRaises(ValueError):
+            MatrixNearestNeighbour(self.session, [mediafile],
+                                   weights={"missing": 1})
+
+    def test_projection(self):
+        path = os.path.join(SOUND_DIR, "hot_tamales.wav")
+        mediafile = add_mediafile(self.session, path, segmentation="beats",
+                                  storage="packed")
+        fit_projection(self.session, dims=8)
+        self.session.flush()
+
+        selector = MatrixNearestNeighbour(self.session, [mediafile],
+                                          projection="default")
+        self.assertEqual(selector.matrix.shape[1], 8)
+        for unit in mediafile.units:
+            # Silent units on either channel have the same features
+            self.assertTrue(numpy.array_equal(
+                selector.select(unit).features.array, unit.features.array))
+
+        with self.assertRaises(ValueError):
+            MatrixNearestNeighbour(self.session, [mediafile],
+                                   projection="default", normalize=True)
+
+
+class RandomUnitTests(DatabaseTests):
+
+    def setUp(self):
+        super(RandomUnitTests, self).setUp()
+        self.target = add_mediafile(
+            self.session, os.path.join(SOUND_DIR, "amen-stereo.wav"),
+            segmentation="beats")
+        self.corpus = add_mediafile(
+            self.session, os.path.join(SOUND_DIR, "amen-mono.wav"),
+            segmentation="beats")
+        self.session.flush()
+
+    def _select(self, seed, batch):
+        pipeline = Pipeline([
+            UnitGenerator(self.target, self.session),
+            RandomUnit(self.session, [self.corpus], seed=seed, batch=batch),
+            list
+        ])
+        return [(pool["target"].id, pool["unit"].id)
+                for pool in pipeline.run()]
+
+    def test_mediafiles(self):
+        results = self._select(0, 4)
+        self.assertEqual(len(results), self.target.units.count())
+        ids = set(unit.id for unit in self.corpus.units)
+        self.assertTrue(all(pk in ids for _, pk in results))
+
+    def test_seed(self):
+        self.assertEqual(self._select(1, 4), self._select(1, 7))
+        self.assertNotEqual(self._select(1, 4), self._select(2, 4))
@@ -17,10 +17,13 @@ from __future__ import unicode_literals
 import os
 import unittest
 
+import numpy
+
 from consyn.base import Pipeline
 from consyn.ext import FileLoader
 from consyn.slicers import BeatSlicer
 from consyn.slicers import RegularSlicer
+from consyn.slicers import Segmentor
 from consyn.slicers import slicer
 
 from . import SOUND_DIR
@@ -50,6 +53,25 @@ from . import SOUND_DIR
 #         ])
 
 
+class SegmentorTests(unittest.TestCase):
+
+    def test_append_and_consume(self):
+        segment = Segmentor(0, None)
+        for block in range(5):
+            segment.append(numpy.arange(block * 3, block * 3 + 3))
+
+        self.assertEqual(list(segment.samples), range(15))
+        samples = segment.consume(4)
+        self.assertEqual(list(samples), range(4))
+        self.assertEqual(list(segment.samples), range(4, 15))
+
+        segment.append(numpy.arange(15, 20))
+        self.assertEqual(list(samples), range(4))
+        self.assertEqual(list(segment.samples), range(4, 20))
+        self.assertEqual(list(segment.consume(100)), range(4, 20))
+        self.assertEqual(segment.length, 0)
+
+
 class BeatSlicerTests(unittest.TestCase):
 
     def test_get_winsize(self):
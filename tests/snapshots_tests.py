@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014, David Poulter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import unicode_literals
+import os
+import shutil
+import tempfile
+
+import numpy
+
+from consyn.commands import add_mediafile
+from consyn.selections import MatrixNearestNeighbour
+from consyn.snapshots import export_snapshot
+from consyn.snapshots import load_snapshot
+from consyn.utils import feature_matrix
+
+from . import DatabaseTests
+from . import SOUND_DIR
+
+
+class SnapshotTests(DatabaseTests):
+
+    def setUp(self):
+        super(SnapshotTests, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.target = add_mediafile(
+            self.session, os.path.join(SOUND_DIR, "amen-mono.wav"),
+            segmentation="beats", storage="packed")
+        self.corpus = add_mediafile(
+            self.session, os.path.join(SOUND_DIR, "hot_tamales.wav"),
+            segmentation="beats", storage="packed")
+        self.session.flush()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_export(self):
+        export_snapshot(self.session, self.path, [self.corpus.id])
+        snapshot = load_snapshot(self.path)
+        self.assertTrue(isinstance(snapshot.features, numpy.memmap))
+
+        ids, matrix = feature_matrix(self.session, [self.corpus.id])
+        self.assertEqual(snapshot.units.tolist(), ids.tolist())
+        self.assertEqual(snapshot.features.tolist(), matrix.tolist())
+        self.assertEqual(len(snapshot.labels), matrix.shape[1])
+        self.assertEqual(snapshot.fingerprint.tolist(),
+                         [[self.corpus.id, len(ids), ids.max()]])
+
+        for unit in self.corpus.units:
+            row = snapshot.units.tolist().index(unit.id)
+            self.assertEqual(snapshot.mediafiles[row], self.corpus.id)
+            self.assertEqual(snapshot.channels[row], unit.channel)
+            self.assertEqual(snapshot.positions[row], unit.position)
+            self.assertEqual(snapshot.durations[row], unit.duration)
+
+    def test_select(self):
+        snapshot = export_snapshot(self.session, self.path)
+        self.assertEqual(len(snapshot), self.target.units.count() +
+                         self.corpus.units.count())
+
+        selected = snapshot.select([self.target.id])
+        self.assertEqual(len(selected), self.target.units.count())
+        self.assertTrue((selected.mediafiles == self.target.id).all())
+
+    def test_selection(self):
+        export_snapshot(self.session, self.path)
+        database = MatrixNearestNeighbour(self.session, [self.corpus])
+        snapshot = MatrixNearestNeighbour(self.session, [self.corpus],
+                                          snapshot=self.path)
+        self.assertEqual(snapshot.ids.tolist(), database.ids.tolist())
+        for unit in self.target.units:
+            self.assertEqual(snapshot.select(unit).id,
+                             database.select(unit).id)
+
+    def test_stale(self):
+        snapshot = export_snapshot(self.session, self.path)
+        self.assertTrue(snapshot.matches(self.session, [self.corpus.id]))
+
+        unit = self.corpus.units.first()
+        self.session.delete(unit.features)
+        self.session.delete(unit)
+        self.session.flush()
+
+        self.assertFalse(snapshot.matches(self.session, [self.corpus.id]))
+        self.assertTrue(snapshot.matches(self.session, [self.target.id]))
+        with self.assertRaises(ValueError):
+            MatrixNearestNeighbour(self.session, [self.corpus],
+                                   snapshot=self.path)
+
+    def test_stale_mediafile(self):
+        export_snapshot(self.session, self.path, [self.corpus.id])
+        with self.assertRaises(ValueError):
+            MatrixNearestNeighbour(self.session, [self.corpus, self.target],
+                                   snapshot=self.path)
@@ -15,9 +15,22 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import unicode_literals
 import os
+import unittest
+
+import numpy
+from sqlalchemy import event
 
 from consyn.base import Pipeline
 from consyn.commands import add_mediafile
+from consyn.models import FeatureSchema
+from consyn.models import Features
+from consyn.models import Unit
+from consyn.utils import RegionCache
+from consyn.utils import combine_stats
+from consyn.utils import feature_column
+from consyn.utils import feature_matrix
+from consyn.utils import feature_stats
+from consyn.utils import subtract_stats
 from consyn.utils import UnitGenerator
 
 from . import DatabaseTests
@@ -43,3 +56,236 @@ class UnitGeneratorTests(DatabaseTests):
 
     def test_mono(self):
         self._test_iter_amount("amen-mono.wav", 13)
+
+    def test_range(self):
+        path = os.path.join(SOUND_DIR, "amen-stereo.wav")
+        mediafile = add_mediafile(self.session, path, segmentation="beats")
+        positions = sorted(set(unit.position for unit in mediafile.units))
+        start, end = positions[2], positions[5]
+
+        pipeline = Pipeline([
+            UnitGenerator(mediafile, self.session, start=start, end=end),
+            list
+        ])
+
+        results = pipeline.run()
+        self.assertEqual(len(results), 6)
+        self.assertEqual(results[0]["unit"].position, start)
+        self.assertTrue(all(start <= pool["unit"].position < end
+                            for pool in results))
+
+    def test_queries(self):
+        path = os.path.join(SOUND_DIR, "amen-stereo.wav")
+        mediafile = add_mediafile(self.session, path, segmentation="beats")
+        self.session.commit()
+        self.session.expire_all()
+
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        engine = self.session.get_bind()
+        event.listen(engine, "before_cursor_execute", count)
+        try:
+            pipeline = Pipeline([
+                UnitGenerator(mediafile, self.session, batch=5),
+                list
+            ])
+            results = pipeline.run()
+            for pool in results:
+                pool["unit"].features.array
+                pool["unit"].mediafile.path
+            repr(mediafile)
+        finally:
+            event.remove(engine, "before_cursor_execute", count)
+
+        self.assertEqual(len(results), 26)
+        # Two batches of units, and a COUNT for the repr of the mediafile
+        self.assertEqual(len(statements), 3)
+        self.assertTrue("count(" in statements[-1].lower())
+
+
+class RegionCacheTests(unittest.TestCase):
+
+    def test_siblings(self):
+        cache = RegionCache()
+        unit = Unit(channel=0, position=10, duration=4)
+        sibling = Unit(channel=1, position=10, duration=3)
+        cache.put("test.wav", unit, numpy.array([[0] * 4, [1] * 4]))
+
+        self.assertEqual(list(cache.get("test.wav", sibling)), [1] * 3)
+        self.assertEqual(cache.get("test.wav", sibling), None)
+        self.assertEqual(len(cache.regions), 0)
+
+    def test_not_siblings(self):
+        cache = RegionCache()
+        unit = Unit(channel=0, position=10, duration=4)
+        cache.put("test.wav", unit, numpy.array([[0] * 4, [1] * 4]))
+
+        self.assertEqual(cache.get("test.wav", unit), None)
+        self.assertEqual(cache.get("other.wav", Unit(
+            channel=1, position=10, duration=4)), None)
+        self.assertEqual(cache.get("test.wav", Unit(
+            channel=1, position=10, duration=5)), None)
+
+    def test_size(self):
+        cache = RegionCache(size=2)
+        for position in range(3):
+            cache.put("test.wav", Unit(channel=0, position=position),
+                      numpy.zeros((2, 4)))
+        self.assertEqual(list(cache.regions.keys()), [
+            ("test.wav", 1), ("test.wav", 2)])
+
+
+class FeatureMatrixTests(DatabaseTests):
+
+    def test_packed_and_columns(self):
+        path = os.path.join(SOUND_DIR, "amen-mono.wav")
+        matrices = []
+
+        for storage in ("columns", "packed"):
+            mediafile = add_mediafile(self.session, path,
+                                      segmentation="beats", storage=storage)
+            self.session.flush()
+            ids, matrix = feature_matrix(self.session, [mediafile.id])
+            self.assertEqual(ids.tolist(), sorted(
+                unit.id for unit in mediafile.units))
+            matrices.append(matrix)
+            self.session.rollback()
+
+        columns, packed = matrices
+        self.assertEqual(columns[:, :packed.shape[1]].tolist(),
+                         packed.tolist())
+
+    def test_mixed(self):
+        mediafiles = [
+            add_mediafile(self.session, os.path.join(SOUND_DIR, name),
+                          segmentation="beats", storage=storage)
+            for name, storage in (("amen-mono.wav", "columns"),
+                                  ("amen-stereo.wav", "packed"))]
+        self.session.flush()
+
+        ids, matrix = feature_matrix(
+            self.session, [mediafile.id for mediafile in mediafiles])
+        units = [unit for mediafile in mediafiles
+                 for unit in mediafile.units]
+        self.assertEqual(ids.tolist(), sorted(unit.id for unit in units))
+        width = mediafiles[1].units.first().features.array.shape[0]
+        self.assertEqual(matrix.shape, (len(units), width))
+        for unit in units:
+            row = matrix[ids.tolist().index(unit.id)]
+            self.assertEqual(row.tolist(),
+                             unit.features.array[:width].tolist())
+
+    def test_mixed_labels(self):
+        path = os.path.join(SOUND_DIR, "amen-mono.wav")
+        mediafile = add_mediafile(self.session, path, segmentation="beats")
+        features = Features({"a": 0.1, "b": 0.2},
+                            schema=FeatureSchema(names="a\nb"))
+        features.mediafile = mediafile
+        features.unit = Unit(mediafile=mediafile, channel=0, position=0,
+                             duration=1)
+        self.session.add(features)
+        self.session.flush()
+
+        with self.assertRaises(ValueError):
+            feature_matrix(self.session, [mediafile.id])
+
+    def test_empty(self):
+        ids, matrix = feature_matrix(self.session, [])
+        self.assertEqual(ids.shape, (0,))
+        self.assertEqual(matrix.shape[0], 0)
+
+
+class FeatureStatsTests(DatabaseTests):
+
+    def _test_storage(self, storage):
+        mediafiles = [
+            add_mediafile(self.session, os.path.join(SOUND_DIR, name),
+                          segmentation="beats", storage=storage)
+            for name in ("amen-mono.wav", "hot_tamales.wav")]
+        self.session.flush()
+
+        ids = [mediafile.id for mediafile in mediafiles]
+        _, matrix = feature_matrix(self.session, ids)
+        mean, std = feature_stats(self.session, ids)
+        self.assertEqual(mean.shape, (matrix.shape[1],))
+        self.assertTrue(numpy.allclose(mean, matrix.mean(axis=0),
+                                       rtol=1e-4, atol=1e-4))
+        self.assertTrue(numpy.allclose(std, matrix.std(axis=0),
+                                       rtol=1e-3, atol=1e-3))
+
+    def test_columns(self):
+        self._test_storage("columns")
+
+    def test_packed(self):
+        self._test_storage("packed")
+
+    def test_missing(self):
+        self.assertEqual(feature_stats(self.session, []), None)
+        self.assertEqual(feature_stats(self.session, [1]), None)
+
+    def test_subset(self):
+        mediafiles = [
+            add_mediafile(self.session, os.path.join(SOUND_DIR, name),
+                          segmentation="beats")
+            for name in ("amen-mono.wav", "hot_tamales.wav", "rimbo.wav")]
+        self.session.flush()
+
+        ids = [mediafile.id for mediafile in mediafiles]
+        # Combined from the rows of one, subtracted from those of all
+        for subset in (ids[:1], ids[1:]):
+            _, matrix = feature_matrix(self.session, subset)
+            mean, std = feature_stats(self.session, subset)
+            self.assertTrue(numpy.allclose(mean, matrix.mean(axis=0),
+                                           rtol=1e-4, atol=1e-4))
+            self.assertTrue(numpy.allclose(std, matrix.std(axis=0),
+                                           rtol=1e-3, atol=1e-3))
+
+    def test_combine_subtract(self):
+        # Sums of squares lose the variance of values far from zero
+        values = 1e8 + numpy.random.RandomState(0).rand(100, 3)
+        whole = (100, values.mean(axis=0),
+                 ((values - values.mean(axis=0)) ** 2).sum(axis=0))
+        parts = [(len(part), part.mean(axis=0),
+                  ((part - part.mean(axis=0)) ** 2).sum(axis=0))
+                 for part in (values[:30], values[30:])]
+
+        count, mean, m2 = combine_stats(parts[0], parts[1])
+        self.assertEqual(count, 100)
+        self.assertTrue(numpy.allclose(mean, whole[1], rtol=1e-12))
+        self.assertTrue(numpy.allclose(m2 / count, values.var(axis=0)))
+
+        count, mean, m2 = subtract_stats(whole, parts[0])
+        self.assertEqual(count, 70)
+        self.assertTrue(numpy.allclose(mean, parts[1][1], rtol=1e-12))
+        self.assertTrue(numpy.allclose(m2, parts[1][2]))
+
+
+class FeatureColumnTests(DatabaseTests):
+
+    def test_storage(self):
+        path = os.path.join(SOUND_DIR, "amen-mono.wav")
+
+        for storage in ("columns", "packed"):
+            mediafile = add_mediafile(self.session, path,
+                                      segmentation="beats", storage=storage)
+            self.session.flush()
+
+            units = mediafile.units.all()
+            units.reverse()
+            labels = [label for _, label, _ in units[0].features]
+
+            for label in labels[:3] + labels[-3:]:
+                values = feature_column(self.session, label,
+                                        [unit.id for unit in units],
+                                        chunksize=5)
+                expected = numpy.array([unit.features[label]
+                                        for unit in units], dtype="float32")
+                self.assertEqual(values.tolist(), expected.tolist())
+
+            values = feature_column(self.session, "missing",
+                                    [unit.id for unit in units])
+            self.assertTrue(numpy.isnan(values).all())
+            self.session.rollback()